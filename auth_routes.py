@@ -1,48 +1,60 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from database import Session, engine
+from fastapi import APIRouter, Depends, HTTPException, Query, Security, status
+from typing import Optional
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_db
+from security import CurrentUser, bearer_scheme, get_current_user, invalidate_user, user_claims
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, keyset, page
+from serializers import USER_COLUMNS, serialize_user
+from query_budget import query_budget
+from ratelimit import admission
+from replicas import get_read_db
 from schemas import SignUpModel, LoginModel, ShowUser
 from models import User
-from werkzeug.security import generate_password_hash, check_password_hash
+from hashing import hash_password, needs_rehash, verify_password
 from fastapi_jwt_auth import AuthJWT
-from fastapi.encoders import jsonable_encoder
+from fastapi.responses import ORJSONResponse
 
 auth_router = APIRouter(
     prefix="/auth",
     tags=["Auth"],
+    dependencies=[Depends(admission)],
 )
 
-session = Session(bind=engine)
-
 
 @auth_router.get("/all", status_code=status.HTTP_200_OK)
-async def auth(Authorize:AuthJWT=Depends()):
+@query_budget(2)
+async def auth(
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    is_staff: Optional[bool] = None,
+    is_active: Optional[bool] = None,
+    user:CurrentUser=Depends(get_current_user),
+    session:AsyncSession=Depends(get_read_db)
+):
     """
         ## Get all users
-        ### Return a list of all users
+        ### Return a page of users, ordered by id
         Only superuser can access this route
+        - On Query:
+            - limit: int (default 50, max 500)
+            - cursor: str, the next_cursor of the previous page
+            - is_staff: bool
+            - is_active: bool
     """
-    try:
-        Authorize.jwt_required()
-    except Exception as e:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid Token [UnAuthorized]")
-    
-    current_user = Authorize.get_jwt_subject()
-    user = session.query(User).filter(User.username == current_user).first()
 
     if user.is_staff:
-        response = []
-        all_users = session.query(User).all()
-
-        for user in all_users:
-            response.append({
-                "id": user.id,
-                "username": user.username,
-                "email": user.email,
-                "is_staff": user.is_staff,
-                "is_active": user.is_active
-            })
-
-        return jsonable_encoder(response)
+        statement = select(*USER_COLUMNS)
+
+        if is_staff is not None:
+            statement = statement.where(User.is_staff == is_staff)
+        if is_active is not None:
+            statement = statement.where(User.is_active == is_active)
+
+        all_users = await session.execute(keyset(statement, User.id, cursor, limit))
+        response = [serialize_user(user) for user in all_users]
+
+        return ORJSONResponse(page(response, limit, "id"))
     
     raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You are not Superuser", headers={"WWW-Authenticate": "Bearer"}) 
 
@@ -52,7 +64,8 @@ async def auth(Authorize:AuthJWT=Depends()):
     # response_model=SignUpModel,
     status_code=status.HTTP_201_CREATED
 )
-async def signup(user: SignUpModel):
+@query_budget(3)
+async def signup(user: SignUpModel, session:AsyncSession=Depends(get_db)):
     """
         ## Create new user
         Any user can create new user with
@@ -62,12 +75,12 @@ async def signup(user: SignUpModel):
         - is_staff: bool
         - is_active: bool
     """
-    db_email = session.query(User).filter(User.email == user.email).first()
+    db_email = await session.scalar(select(User).where(User.email == user.email))
 
     if db_email is not None:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already exists")
     
-    db_username = session.query(User).filter(User.username == user.username).first()
+    db_username = await session.scalar(select(User).where(User.username == user.username))
 
     if db_username is not None:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Username already exists")
@@ -75,34 +88,41 @@ async def signup(user: SignUpModel):
     new_user = User(
         username=user.username,
         email=user.email,
-        password=generate_password_hash(user.password),
+        password=await hash_password(user.password),
         is_staff=user.is_staff,
         is_active=user.is_active
     )
 
     session.add(new_user)
-    session.commit()
+    await session.commit()
+    invalidate_user(new_user.id, new_user.username)
     
     return {"message": "User created successfully"}
 
 # Login route
 @auth_router.post("/login", status_code=status.HTTP_200_OK)
-async def login(user: LoginModel, Authorize:AuthJWT=Depends()):
+@query_budget(2)
+async def login(user: LoginModel, Authorize:AuthJWT=Depends(), session:AsyncSession=Depends(get_db)):
     """
         ## Login user
         - username: str
         - password: str
     """
-    db_user = session.query(User).filter(User.username == user.username).first()
+    db_user = await session.scalar(select(User).where(User.username == user.username))
 
     if db_user is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
 
-    if not check_password_hash(db_user.password, user.password):
+    if not await verify_password(db_user.password, user.password):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect password")
 
+    # upgrade hashes made with outdated parameters while we have the password
+    if needs_rehash(db_user.password):
+        db_user.password = await hash_password(user.password)
+        await session.commit()
+
     try:
-        access_token = Authorize.create_access_token(subject=db_user.username)
+        access_token = Authorize.create_access_token(subject=db_user.username, user_claims=user_claims(db_user))
         refresh_token = Authorize.create_refresh_token(subject=db_user.username)
 
         response = {
@@ -112,11 +132,12 @@ async def login(user: LoginModel, Authorize:AuthJWT=Depends()):
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid Token")
 
-    return jsonable_encoder(response)
+    return response
 
 # Refresh token route
-@auth_router.post("/refresh", status_code=status.HTTP_200_OK)
-async def refresh(Authorize:AuthJWT=Depends()):
+@auth_router.post("/refresh", status_code=status.HTTP_200_OK, dependencies=[Security(bearer_scheme)])
+@query_budget(1)
+async def refresh(Authorize:AuthJWT=Depends(), session:AsyncSession=Depends(get_db)):
     """
         ## Refresh token
         Return new access token
@@ -125,8 +146,15 @@ async def refresh(Authorize:AuthJWT=Depends()):
         Authorize.jwt_refresh_token_required()
         current_user = Authorize.get_jwt_subject()
         # current_user = Authorize.get_jwt_identity()
-        new_access_token = Authorize.create_access_token(subject=current_user)
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid Refresh Token")
 
-    return jsonable_encoder({"access_token": new_access_token})
\ No newline at end of file
+    # re-read the user so the new token carries its current flags
+    db_user = await session.scalar(select(User).where(User.username == current_user))
+
+    if db_user is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid Refresh Token")
+
+    new_access_token = Authorize.create_access_token(subject=current_user, user_claims=user_claims(db_user))
+
+    return {"access_token": new_access_token}
\ No newline at end of file
@@ -0,0 +1,153 @@
+import asyncio
+import contextvars
+
+import environ
+from sqlalchemy.exc import DataError, DBAPIError, IntegrityError, StatementError
+
+from counters import apply_counters, count_order
+from crud import insert_orders
+from database import AsyncSessionLocal
+
+
+env = environ.Env(DEBUG=(bool, False))
+environ.Env.read_env(".env")
+
+# Create the orders of concurrent POST /orders/order requests in shared transactions
+ORDER_BATCHING = env.bool("ORDER_BATCHING", default=False)
+
+# Orders per transaction, and seconds the first order of a batch waits for others to join it
+ORDER_BATCH_SIZE = env.int("ORDER_BATCH_SIZE", default=100)
+ORDER_BATCH_LINGER = env.float("ORDER_BATCH_LINGER", default=0.002)
+
+
+def row_error(e):
+    """
+        Whether an error is caused by the values of some rows, and splitting the batch isolates them
+    """
+    if isinstance(e, (IntegrityError, DataError)):
+        return True
+    # values a bind processor or the driver couldn't convert, before reaching the database
+    if isinstance(e, StatementError) and not isinstance(e, DBAPIError):
+        return True
+    return isinstance(e, (ValueError, ArithmeticError))
+
+
+class OrderBatcher:
+    """
+        Group commit of order inserts: the rows queued by the requests are inserted by a background
+        task, a batch at a time, with one INSERT (... RETURNING where supported) and one commit
+        If a row of a batch is at fault, the batch is split in halves and retried, down to single
+        rows, so only the faulty ones fail their request. Other errors (connection lost, database
+        down) fail the whole batch at once
+    """
+
+    def __init__(self, size=None, linger=None):
+        self.size = ORDER_BATCH_SIZE if size is None else size
+        self.linger = ORDER_BATCH_LINGER if linger is None else linger
+        self.queue = None
+        self.task = None
+        self.batches = 0
+        self.orders = 0
+        self.retried = 0
+
+    def start(self):
+        """
+            Start the task inserting the batches, in an empty context: a task copies the context it
+            is created in, and it must not carry the query counters or user of a request
+        """
+        if self.task is None:
+            self.queue = asyncio.Queue()
+            self.task = contextvars.Context().run(asyncio.create_task, self.run())
+
+    async def stop(self):
+        """
+            Insert the orders already queued, then stop
+        """
+        if self.task is not None:
+            self.queue.put_nowait(None)
+            await self.task
+            self.task = None
+
+    async def insert(self, row):
+        """
+            Queue an order row, return its id once its batch is committed
+        """
+        # started by the startup hook, or here when the app runs without its startup hooks
+        self.start()
+
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((row, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+
+            batch = [item]
+            deadline = loop.time() + self.linger
+            while len(batch) < self.size:
+                if self.queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    item = self.queue.get_nowait()
+
+                if item is None:
+                    # put back for the outer loop, once this batch is written
+                    self.queue.put_nowait(None)
+                    break
+                batch.append(item)
+
+            await self.flush(batch)
+
+    async def flush(self, batch):
+        rows = [row for row, future in batch]
+        try:
+            async with AsyncSessionLocal() as session:
+                order_ids = await insert_orders(session, rows)
+
+                deltas = {}
+                for row in rows:
+                    count_order(deltas, row["user_id"], row["order_status"], row["pizza_size"], row["quantity"])
+                await apply_counters(session, deltas)
+                await session.commit()
+        except Exception as e:
+            if len(batch) > 1 and row_error(e):
+                self.retried += len(batch)
+                middle = len(batch) // 2
+                await self.flush(batch[:middle])
+                await self.flush(batch[middle:])
+                return
+
+            for row, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.orders += len(batch)
+        for (row, future), order_id in zip(batch, order_ids):
+            # the request may have been cancelled meanwhile, its order is created all the same
+            if not future.done():
+                future.set_result(order_id)
+
+    def stats(self):
+        return {
+            "running": self.task is not None,
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+            "batches": self.batches,
+            "orders": self.orders,
+            "orders_per_batch": round(self.orders / self.batches, 2) if self.batches else 0.0,
+            "retried": self.retried,
+        }
+
+
+order_batcher = OrderBatcher()
@@ -0,0 +1,125 @@
+"""
+    Concurrent-request throughput of a blocking vs an asyncio database session
+
+    Both routes run the same lookup inside an `async def` handler:
+    - /blocking/{id}: synchronous Session (the pre-asyncio handlers)
+    - /async/{id}: AsyncSession from database.get_db
+
+    --db-latency emulates a server round trip with pg_sleep on Postgres or a
+    sleeping SQL function on SQLite, so the event-loop stall is visible locally.
+
+    Usage:
+        python bench/async_db.py --requests 500 --concurrency 50 --db-latency 0.005
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", "sqlite:///./bench.db")
+os.environ.setdefault("SECRET_KEY", "bench")
+
+import httpx
+from fastapi import Depends, FastAPI
+from sqlalchemy import event, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import Base, Session, async_engine, engine, get_db
+from models import Order, User
+
+
+def sleep_statement():
+    if engine.dialect.name == "postgresql":
+        return text("SELECT pg_sleep(:seconds)")
+    return text("SELECT bench_sleep(:seconds)")
+
+
+def register_sqlite_sleep(sync_engine):
+    @event.listens_for(sync_engine, "connect")
+    def _connect(dbapi_connection, connection_record):
+        dbapi_connection.create_function("bench_sleep", 1, time.sleep)
+
+
+def seed(orders):
+    Base.metadata.create_all(bind=engine)
+    with Session() as session:
+        if session.scalar(select(Order.id).limit(1)) is None:
+            user = User(username="bench", email="bench@example.com", password="x", is_active=True)
+            session.add(user)
+            session.flush()
+            session.add_all(Order(quantity=1, pizza_size="SMALL", user_id=user.id) for _ in range(orders))
+            session.commit()
+
+
+def build_app(latency):
+    app = FastAPI()
+    statement = sleep_statement()
+
+    @app.get("/blocking/{order_id}")
+    async def blocking(order_id: int):
+        with Session() as session:
+            if latency:
+                session.execute(statement, {"seconds": latency})
+            order = session.get(Order, order_id)
+            return {"order_id": order.id}
+
+    @app.get("/async/{order_id}")
+    async def non_blocking(order_id: int, session: AsyncSession = Depends(get_db)):
+        if latency:
+            await session.execute(statement, {"seconds": latency})
+        order = await session.get(Order, order_id)
+        return {"order_id": order.id}
+
+    return app
+
+
+async def drive(app, route, requests, concurrency, orders):
+    transport = httpx.ASGITransport(app=app)
+    queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(i % orders + 1)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def worker():
+            while not queue.empty():
+                order_id = queue.get_nowait()
+                response = await client.get("/{}/{}".format(route, order_id))
+                response.raise_for_status()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(requests / elapsed, 1),
+    }
+
+
+async def main(args):
+    if engine.dialect.name == "sqlite":
+        register_sqlite_sleep(engine)
+        register_sqlite_sleep(async_engine.sync_engine)
+
+    seed(args.orders)
+    app = build_app(args.db_latency)
+
+    results = {}
+    for route in ("blocking", "async"):
+        results[route] = await drive(app, route, args.requests, args.concurrency, args.orders)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--orders", type=int, default=100)
+    parser.add_argument("--db-latency", type=float, default=0.005, help="seconds per emulated round trip")
+    asyncio.run(main(parser.parse_args()))
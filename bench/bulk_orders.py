@@ -0,0 +1,65 @@
+"""
+    Orders per second through POST /orders/order vs POST /orders/order/bulk
+
+    Usage:
+        python bench/bulk_orders.py --orders 2000 --concurrency 20 --batch-size 500
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import common
+
+
+async def single(client, headers, orders, concurrency):
+    queue = asyncio.Queue()
+    for _ in range(orders):
+        queue.put_nowait({"quantity": 1, "pizza_size": "LARGE"})
+
+    async def worker():
+        while not queue.empty():
+            response = await client.post("/api/orders/order", json=queue.get_nowait(), headers=headers)
+            response.raise_for_status()
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+async def bulk(client, headers, orders, batch_size):
+    for start in range(0, orders, batch_size):
+        batch = [{"quantity": 1, "pizza_size": "LARGE"} for _ in range(min(batch_size, orders - start))]
+        response = await client.post("/api/orders/order/bulk", json=batch, headers=headers)
+        response.raise_for_status()
+
+
+async def main(args):
+    common.create_schema()
+    from main import app
+
+    results = {}
+    async with common.client(app) as client:
+        _, headers = await common.signup_and_login(client)
+
+        for name, run in (
+            ("single", lambda: single(client, headers, args.orders, args.concurrency)),
+            ("bulk", lambda: bulk(client, headers, args.orders, args.batch_size)),
+        ):
+            started = time.perf_counter()
+            await run()
+            elapsed = time.perf_counter() - started
+            results[name] = {
+                "orders": args.orders,
+                "seconds": round(elapsed, 3),
+                "orders_per_second": round(args.orders / elapsed, 1),
+            }
+
+    results["speedup"] = round(results["bulk"]["orders_per_second"] / results["single"]["orders_per_second"], 1)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--orders", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=500)
+    asyncio.run(main(parser.parse_args()))
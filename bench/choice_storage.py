@@ -0,0 +1,175 @@
+"""
+    Size of the orders table and cost of listing it, order status and pizza size stored as
+    strings (migration 0004, ChoiceType) vs small integer codes (migration 0005, CodedChoice)
+
+    Seeds an empty database at 0004, measures, runs the 0005 data migration, measures again:
+    - table_bytes / index_bytes of orders (after VACUUM)
+    - list_orders_per_second: every order read in keyset pages of MAX_PAGE_SIZE, serialized and
+      encoded like GET /orders/all, and the same filtered on a status (partial index)
+
+    Usage:
+        python bench/choice_storage.py --orders 200000
+        DATABASE_URL=postgresql://.../scratch python bench/choice_storage.py   (an empty database)
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+# a fresh database of its own, the migrations start from an empty one
+if "DATABASE_URL" not in os.environ:
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "choice_storage.db")
+
+import common
+
+import orjson
+import sqlalchemy as sa
+from alembic import command
+from alembic.config import Config
+from sqlalchemy_utils.types import ChoiceType
+
+STATUS_WEIGHTS = (("PENDING", 1), ("IN-TRANSIT", 2), ("DELIVERED", 7))
+SIZES = ("SMALL", "MEDIUM", "LARGE", "EXTRA-LARGE")
+
+
+def seed(engine, orders):
+    """
+        Orders of 100 users with string statuses and sizes, inserted at revision 0004
+    """
+    statuses = [status for status, weight in STATUS_WEIGHTS for _ in range(weight)]
+    random.seed(0)
+    with engine.begin() as connection:
+        connection.execute(sa.text("INSERT INTO users (username, email, password, is_staff, is_active) VALUES {}".format(
+            ", ".join("('bench-choice-{0}', 'bench-choice-{0}@example.com', 'x', false, true)".format(i) for i in range(100))
+        )))
+        user_ids = list(connection.scalars(sa.text("SELECT id FROM users")))
+        orders_table = sa.table("orders", *(sa.column(name) for name in ("quantity", "order_status", "pizza_size", "user_id")))
+        for start in range(0, orders, 10000):
+            connection.execute(orders_table.insert(), [
+                {
+                    "quantity": random.randint(1, 5),
+                    "order_status": random.choice(statuses),
+                    "pizza_size": random.choice(SIZES),
+                    "user_id": random.choice(user_ids),
+                }
+                for _ in range(min(10000, orders - start))
+            ])
+
+
+def sizes(engine):
+    """
+        (table bytes, index bytes) of orders
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        if engine.dialect.name == "postgresql":
+            connection.exec_driver_sql("VACUUM FULL orders")
+            return tuple(connection.exec_driver_sql("SELECT pg_table_size('orders'), pg_indexes_size('orders')").one())
+
+        connection.exec_driver_sql("VACUUM")
+        pages = dict(connection.exec_driver_sql(
+            "SELECT dbstat.name, SUM(pgsize) FROM dbstat JOIN sqlite_master ON sqlite_master.name = dbstat.name "
+            "WHERE sqlite_master.tbl_name = 'orders' GROUP BY dbstat.name"
+        ).all())
+        table = pages.pop("orders")
+        return table, sum(size for name, size in pages.items() if not name.startswith("sqlite_autoindex"))
+
+
+def list_orders(engine, columns, serialize, order_status=None):
+    """
+        Seconds to read every order (or every order of a status) in keyset pages, serialized and encoded
+    """
+    from pagination import MAX_PAGE_SIZE
+
+    id_column = columns[0]
+    statement = sa.select(*columns)
+    if order_status is not None:
+        statement = statement.where(columns[2] == order_status)
+
+    started = time.perf_counter()
+    count = 0
+    with engine.connect() as connection:
+        last_id = 0
+        while True:
+            rows = connection.execute(statement.where(id_column > last_id).order_by(id_column).limit(MAX_PAGE_SIZE + 1)).all()
+            orjson.dumps({"items": [serialize(row) for row in rows[:MAX_PAGE_SIZE]]})
+            count += min(len(rows), MAX_PAGE_SIZE)
+            if len(rows) <= MAX_PAGE_SIZE:
+                break
+            last_id = rows[MAX_PAGE_SIZE - 1].id
+    return count, time.perf_counter() - started
+
+
+def measure(engine, columns, serialize, repeat):
+    table_bytes, index_bytes = sizes(engine)
+    result = {"table_bytes": table_bytes, "index_bytes": index_bytes}
+    for name, order_status in (("all", None), ("pending", "PENDING")):
+        count, seconds = min((list_orders(engine, columns, serialize, order_status) for _ in range(repeat)), key=lambda run: run[1])
+        result["list_{}_orders".format(name)] = count
+        result["list_{}_orders_per_second".format(name)] = round(count / seconds)
+    return result
+
+
+def string_columns():
+    """
+        orders as mapped before 0005: ChoiceType, loaded as Choice objects the handlers read .code of
+    """
+    from models import Order
+
+    orders = sa.Table(
+        "orders", sa.MetaData(),
+        sa.Column("id", sa.Integer, primary_key=True),
+        sa.Column("quantity", sa.Integer),
+        sa.Column("order_status", ChoiceType(Order.ORDER_STATUSES)),
+        sa.Column("pizza_size", ChoiceType(Order.PIZZA_SIZES)),
+        sa.Column("user_id", sa.Integer),
+    )
+    return (orders.c.id, orders.c.quantity, orders.c.order_status, orders.c.pizza_size, orders.c.user_id)
+
+
+def serialize_choice_row(row):
+    return {
+        "order_id": row.id,
+        "quantity": row.quantity,
+        "order_status": getattr(row.order_status, "code", row.order_status),
+        "pizza_size": getattr(row.pizza_size, "code", row.pizza_size),
+        "user_id": row.user_id,
+    }
+
+
+def main(args):
+    from database import engine
+    from serializers import ORDER_COLUMNS, serialize_order
+
+    if sa.inspect(engine).has_table("orders"):
+        sys.exit("{} already has an orders table, give an empty database".format(engine.url.render_as_string(hide_password=True)))
+
+    config = Config(os.path.join(common.ROOT, "alembic.ini"))
+    command.upgrade(config, "0004")
+    seed(engine, args.orders)
+
+    results = {"dialect": engine.dialect.name, "orders": args.orders}
+    results["strings"] = measure(engine, string_columns(), serialize_choice_row, args.repeat)
+
+    started = time.perf_counter()
+    command.upgrade(config, "0005")
+    results["migration_seconds"] = round(time.perf_counter() - started, 2)
+
+    # ORDER_COLUMNS has id first and order_status third, like string_columns
+    results["codes"] = measure(engine, ORDER_COLUMNS, serialize_order, args.repeat)
+
+    for key in ("table_bytes", "index_bytes"):
+        results[key.replace("bytes", "saved")] = round(1 - results["codes"][key] / results["strings"][key], 3)
+    for name in ("all", "pending"):
+        key = "list_{}_orders_per_second".format(name)
+        results["list_{}_speedup".format(name)] = round(results["codes"][key] / results["strings"][key], 2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--orders", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=3)
+    main(parser.parse_args())
@@ -0,0 +1,50 @@
+"""
+    Shared setup of the benchmarks: a local database, the app and an authenticated client
+"""
+import os
+import sys
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, ROOT)
+# absolute, so servers started by the benchmarks use the same file
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(ROOT, "bench.db"))
+os.environ.setdefault("SECRET_KEY", "bench")
+# every bench client shares one IP and a few users, set these to measure with the limits on
+os.environ.setdefault("RATE_LIMIT_USER_RATE", "0")
+os.environ.setdefault("RATE_LIMIT_IP_RATE", "0")
+os.environ.setdefault("ADMISSION_LIMIT", "0")
+
+import httpx
+
+
+def create_schema():
+    from database import Base, engine
+    import models
+
+    Base.metadata.create_all(bind=engine)
+
+
+def client(app):
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=None)
+
+
+async def signup_and_login(client, is_staff=False):
+    """
+        Create a throwaway user, return (username, authorization headers)
+    """
+    username = "bench-{}".format(uuid.uuid4().hex[:12])
+    response = await client.post("/api/auth/signup", json={
+        "username": username,
+        "email": "{}@example.com".format(username),
+        "password": "bench",
+        "is_staff": is_staff,
+        "is_active": True,
+    })
+    response.raise_for_status()
+
+    response = await client.post("/api/auth/login", json={"username": username, "password": "bench"})
+    response.raise_for_status()
+
+    return username, {"Authorization": "Bearer {}".format(response.json()["access_token"])}
@@ -0,0 +1,237 @@
+"""
+    Throughput and latency percentiles of every route, driven by concurrent async clients
+
+    Seeds the database (DATABASE_URL, a local SQLite file by default) with --users users and
+    --orders orders, then runs each scenario for --requests requests with --concurrency clients
+    and prints one JSON report, to compare across commits.
+
+    The app runs in-process unless --url points at a running server using the same database.
+
+    Usage:
+        python bench/routes.py --users 100 --orders 10000 --requests 500 --concurrency 20
+        python bench/routes.py --url http://127.0.0.1:8000 --output bench.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import sys
+import time
+import uuid
+
+import common
+
+import httpx
+from sqlalchemy import func, insert, select
+
+
+PASSWORD = "bench"
+
+
+def seed(users, orders):
+    """
+        Create the bench users (the first one is staff) and orders, return the order ids per user
+    """
+    from database import Session
+    from hashing import PASSWORD_HASH_METHOD
+    from models import Order, User
+    from werkzeug.security import generate_password_hash
+
+    with Session() as session:
+        existing = session.scalar(select(func.count(User.id)).where(User.username.like("bench-user-%")))
+        if existing < users:
+            password = generate_password_hash(PASSWORD, PASSWORD_HASH_METHOD)
+            session.execute(insert(User), [
+                {
+                    "username": "bench-user-{}".format(i),
+                    "email": "bench-user-{}@example.com".format(i),
+                    "password": password,
+                    "is_staff": i == 0,
+                    "is_active": True,
+                }
+                for i in range(existing, users)
+            ])
+
+        user_ids = list(session.scalars(
+            select(User.id).where(User.username.like("bench-user-%")).order_by(User.id).limit(users)
+        ))
+
+        existing = session.scalar(select(func.count(Order.id)).where(Order.user_id.in_(user_ids)))
+        if existing < orders:
+            session.execute(insert(Order), [
+                {"quantity": 1 + i % 5, "order_status": "PENDING", "pizza_size": "LARGE", "user_id": user_ids[i % len(user_ids)]}
+                for i in range(existing, orders)
+            ])
+        session.commit()
+
+        owned = {user_id: [] for user_id in user_ids}
+        for order_id, user_id in session.execute(select(Order.id, Order.user_id).where(Order.user_id.in_(user_ids))):
+            owned[user_id].append(order_id)
+
+    return user_ids, owned
+
+
+def percentile(latencies, fraction):
+    if not latencies:
+        return None
+    index = min(len(latencies) - 1, max(0, int(round(fraction * len(latencies))) - 1))
+    return round(latencies[index] * 1000, 2)
+
+
+async def run(client, requests, concurrency, make_request, on_response=None):
+    """
+        Send `requests` requests built by make_request(i) from `concurrency` clients
+        on_response(kwargs, response) sees every response, outside of the measured time
+    """
+    counter = itertools.count()
+    latencies, errors = [], 0
+
+    async def worker():
+        nonlocal errors
+        while True:
+            i = next(counter)
+            if i >= requests:
+                return
+            method, url, kwargs = make_request(i)
+            started = time.perf_counter()
+            try:
+                response = await client.request(method, url, **kwargs)
+                failed = response.status_code >= 400
+            except httpx.HTTPError:
+                failed = True
+            latencies.append(time.perf_counter() - started)
+            errors += failed
+            if on_response is not None and not failed:
+                on_response(kwargs, response)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(requests / elapsed, 1),
+        "p50_ms": percentile(latencies, 0.50),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+    }
+
+
+async def login(client, user_ids, count):
+    """
+        Log `count` seeded users in, return [(user_id, headers)], the staff user first
+    """
+    sessions = []
+    for index, user_id in enumerate(user_ids[:count]):
+        response = await client.post("/api/auth/login", json={"username": "bench-user-{}".format(index), "password": PASSWORD})
+        response.raise_for_status()
+        sessions.append((user_id, {"Authorization": "Bearer {}".format(response.json()["access_token"])}))
+    return sessions
+
+
+async def bench(client, args, user_ids, owned):
+    staff_headers = (await login(client, user_ids, 1))[0][1]
+    customers = (await login(client, user_ids, min(len(user_ids), args.logged_in + 1)))[1:] or [(user_ids[0], staff_headers)]
+    customers = [(user_id, headers) for user_id, headers in customers if owned[user_id]] or customers
+    all_orders = [order_id for order_ids in owned.values() for order_id in order_ids]
+    created = []
+
+    def customer(i):
+        return customers[i % len(customers)]
+
+    def owned_order(i):
+        user_id, headers = customer(i)
+        return random.choice(owned[user_id]), headers
+
+    run_id = uuid.uuid4().hex[:8]
+
+    scenarios = [
+        ("signup", lambda i: ("POST", "/api/auth/signup", {"json": {
+            "username": "bench-{}-{}".format(run_id, i), "email": "bench-{}-{}@example.com".format(run_id, i),
+            "password": PASSWORD, "is_staff": False, "is_active": True}})),
+        ("login", lambda i: ("POST", "/api/auth/login", {"json": {
+            "username": "bench-user-{}".format(i % len(user_ids)), "password": PASSWORD}})),
+        ("list_orders", lambda i: ("GET", "/api/orders/all", {"headers": staff_headers})),
+        ("list_users", lambda i: ("GET", "/api/auth/all", {"headers": staff_headers})),
+        ("order_stats", lambda i: ("GET", "/api/orders/stats", {"headers": staff_headers})),
+        ("get_order", lambda i: ("GET", "/api/orders/{}".format(random.choice(all_orders)), {"headers": staff_headers})),
+        ("user_orders", lambda i: ("GET", "/api/orders/user/orders", {"headers": customer(i)[1]})),
+        ("user_order", lambda i: (lambda order_id, headers: (
+            "GET", "/api/orders/user/order/{}".format(order_id), {"headers": headers}))(*owned_order(i))),
+        ("create_order", lambda i: ("POST", "/api/orders/order", {
+            "json": {"quantity": 1, "pizza_size": "MEDIUM"}, "headers": customer(i)[1]})),
+        ("patch_order", lambda i: ("PATCH", "/api/orders/order/update/{}".format(created[i % len(created)][0]), {
+            "json": {"quantity": 2}, "headers": created[i % len(created)][1]})),
+        ("order_status", lambda i: ("PUT", "/api/orders/order/status/{}".format(random.choice(all_orders)), {
+            "json": {"order_status": "IN-TRANSIT"}, "headers": staff_headers})),
+        ("delete_order", lambda i: ("DELETE", "/api/orders/order/delete/{}".format(created[i][0]), {
+            "headers": created[i][1]})),
+    ]
+
+    # patch_order and delete_order work on the orders made by create_order, still pending
+    def record_created(kwargs, response):
+        created.append((response.json()["order_id"], kwargs["headers"]))
+
+    results = {}
+    for name, make_request in scenarios:
+        if args.routes and name not in args.routes:
+            continue
+        if name in ("patch_order", "delete_order") and not created:
+            continue
+        requests = min(args.requests, len(created)) if name == "delete_order" else args.requests
+        on_response = record_created if name == "create_order" else None
+        results[name] = await run(client, requests, args.concurrency, make_request, on_response)
+
+    return results
+
+
+async def main(args):
+    common.create_schema()
+    user_ids, owned = seed(args.users, args.orders)
+
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=None)
+    else:
+        from main import app
+        client = common.client(app)
+
+    async with client:
+        results = await bench(client, args, user_ids, owned)
+
+    report = {
+        "config": {
+            "target": args.url or "in-process",
+            "users": args.users,
+            "orders": args.orders,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+        },
+        "routes": results,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as report_file:
+            report_file.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--orders", type=int, default=10000)
+    parser.add_argument("--requests", type=int, default=500, help="requests per route")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--logged-in", type=int, default=20, help="customers sending the per-user requests")
+    parser.add_argument("--routes", nargs="*", help="only run these scenarios")
+    parser.add_argument("--url", help="base url of a running server, in-process app by default")
+    parser.add_argument("--output", help="also write the report to this file")
+    args = parser.parse_args()
+
+    if args.users < 2:
+        sys.exit("--users must be at least 2")
+    asyncio.run(main(args))
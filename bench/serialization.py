@@ -0,0 +1,100 @@
+"""
+    Cost of loading and encoding a list of orders, ORM + jsonable_encoder vs columns + orjson
+
+    - before: hydrate Order objects, build the dicts by hand, jsonable_encoder twice (handler
+      and FastAPI) then JSONResponse
+    - after: select ORDER_COLUMNS, serializers.serialize_order, ORJSONResponse
+
+    Usage:
+        python bench/serialization.py --orders 100000
+"""
+import argparse
+import json
+import time
+
+import common
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+from sqlalchemy import func, insert, select
+
+
+def seed(Session, Order, User, orders):
+    with Session() as session:
+        count = session.scalar(select(func.count(Order.id)))
+        if count >= orders:
+            return
+
+        user = User(username="bench-serialization", email="bench-serialization@example.com", password="x")
+        session.add(user)
+        session.flush()
+        session.execute(insert(Order), [
+            {"quantity": 1 + i % 5, "order_status": "PENDING", "pizza_size": "LARGE", "user_id": user.id}
+            for i in range(orders - count)
+        ])
+        session.commit()
+
+
+def before(session, Order, limit):
+    started = time.perf_counter()
+    orders = session.scalars(select(Order).limit(limit)).all()
+    loaded = time.perf_counter()
+
+    response = []
+    for order in orders:
+        response.append({
+            "order_id": order.id,
+            "quantity": order.quantity,
+            "order_status": order.order_status,
+            "pizza_size": order.pizza_size,
+            "user_id": order.user_id
+        })
+    body = JSONResponse(jsonable_encoder(jsonable_encoder(response))).body
+    return loaded - started, time.perf_counter() - loaded, len(body)
+
+
+def after(session, Order, limit):
+    from serializers import ORDER_COLUMNS, serialize_order
+
+    started = time.perf_counter()
+    orders = session.execute(select(*ORDER_COLUMNS).limit(limit)).all()
+    loaded = time.perf_counter()
+
+    body = ORJSONResponse([serialize_order(order) for order in orders]).body
+    return loaded - started, time.perf_counter() - loaded, len(body)
+
+
+def main(args):
+    common.create_schema()
+    from database import Session
+    from models import Order, User
+
+    seed(Session, Order, User, args.orders)
+
+    results = {}
+    for name, run in (("before", before), ("after", after)):
+        best = None
+        for _ in range(args.repeat):
+            with Session() as session:
+                load, encode, size = run(session, Order, args.orders)
+            if best is None or load + encode < best[0] + best[1]:
+                best = (load, encode, size)
+
+        results[name] = {
+            "orders": args.orders,
+            "load_seconds": round(best[0], 3),
+            "encode_seconds": round(best[1], 3),
+            "total_seconds": round(best[0] + best[1], 3),
+            "bytes": best[2],
+        }
+
+    results["encode_speedup"] = round(results["before"]["encode_seconds"] / results["after"]["encode_seconds"], 1)
+    results["total_speedup"] = round(results["before"]["total_seconds"] / results["after"]["total_seconds"], 1)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--orders", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    main(parser.parse_args())
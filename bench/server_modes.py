@@ -0,0 +1,104 @@
+"""
+    Throughput of the dev run mode (one process, reload) against the prod one (WORKERS processes,
+    uvloop, httptools), over real sockets
+
+    Starts `python main.py` in each mode on --port, runs bench/routes.py against it and prints
+    both reports and the speedup per route as JSON. Read routes by default: on SQLite, writes
+    from several workers mostly measure the database lock.
+
+    Usage:
+        python bench/server_modes.py --workers 4 --requests 2000 --concurrency 64
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import common
+from common import ROOT
+
+import httpx
+
+
+READ_ROUTES = ["login", "list_orders", "get_order", "user_orders", "user_order", "order_stats"]
+
+
+def wait_until_ready(url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            sys.exit("server exited with {}".format(process.returncode))
+        try:
+            if httpx.get(url + "/api/health/pool").status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    sys.exit("server not ready after {}s".format(timeout))
+
+
+def run_mode(mode, args):
+    url = "http://127.0.0.1:{}".format(args.port)
+    env = dict(
+        os.environ,
+        RUN_MODE=mode,
+        HOST="127.0.0.1",
+        PORT=str(args.port),
+        RELOAD="True",
+        WORKERS=str(args.workers),
+        ORDER_COUNTER_RECONCILE_INTERVAL="0",
+    )
+    server = subprocess.Popen([sys.executable, "main.py"], cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_ready(url, server)
+
+        with tempfile.NamedTemporaryFile(suffix=".json") as report:
+            subprocess.run([
+                sys.executable, os.path.join(ROOT, "bench", "routes.py"),
+                "--url", url,
+                "--users", str(args.users),
+                "--orders", str(args.orders),
+                "--requests", str(args.requests),
+                "--concurrency", str(args.concurrency),
+                "--routes", *args.routes,
+                "--output", report.name,
+            ], cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+            return json.load(open(report.name))
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def main(args):
+    # seeded once here, so both modes start from the same database
+    common.create_schema()
+
+    reports = {mode: run_mode(mode, args) for mode in ("dev", "prod")}
+
+    speedup = {}
+    for route, prod in reports["prod"]["routes"].items():
+        dev = reports["dev"]["routes"].get(route)
+        if dev:
+            speedup[route] = round(prod["requests_per_second"] / dev["requests_per_second"], 2)
+
+    print(json.dumps({
+        "workers": args.workers,
+        "dev": reports["dev"]["routes"],
+        "prod": reports["prod"]["routes"],
+        "speedup": speedup,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--orders", type=int, default=10000)
+    parser.add_argument("--requests", type=int, default=2000, help="requests per route")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--routes", nargs="*", default=READ_ROUTES)
+    main(parser.parse_args())
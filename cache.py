@@ -0,0 +1,181 @@
+import importlib
+import time
+from collections import OrderedDict
+
+
+def load_backend(path, **options):
+    """
+        Instance of the class at a dotted path ("module.Class"), for the backends picked in the settings
+    """
+    module, name = path.rsplit(".", 1)
+    return getattr(importlib.import_module(module), name)(**options)
+
+
+class TTLCache:
+    """
+        Bounded in-process cache with LRU eviction and a per-entry time to live
+        Not shared between workers, each process keeps its own copy
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+
+        expires, value = item
+        if expires < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        item = self._data.get(key)
+        return item is not None and item[0] >= time.monotonic()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+class CacheBackend:
+    """
+        Interface of the response caches, values are bytes so a shared store can hold them as is
+        - get(key): the value or None
+        - set(key, value, ttl=None)
+        - delete(key)
+        - stats(): hits, misses, hit_ratio, memory...
+    """
+
+    async def get(self, key):
+        raise NotImplementedError
+
+    async def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    async def delete(self, key):
+        raise NotImplementedError
+
+    def stats(self):
+        return {}
+
+
+class LocalCache(CacheBackend):
+    """
+        CacheBackend kept in this worker, a TTLCache
+        Invalidations only reach this worker, others keep their copy until it expires
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(self, key):
+        return self.cache.get(key)
+
+    async def set(self, key, value, ttl=None):
+        self.cache.set(key, value, ttl)
+
+    async def delete(self, key):
+        self.cache.pop(key)
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats["memory_bytes"] = sum(len(value) for _, value in self.cache._data.values())
+        return stats
+
+
+class NullCache(CacheBackend):
+    """
+        CacheBackend keeping nothing, every read goes to the database
+        The default of the order cache with several workers and no shared backend
+    """
+
+    def __init__(self, maxsize=None, ttl=None):
+        self.misses = 0
+
+    async def get(self, key):
+        self.misses += 1
+        return None
+
+    async def set(self, key, value, ttl=None):
+        pass
+
+    async def delete(self, key):
+        pass
+
+    def stats(self):
+        return {"size": 0, "hits": 0, "misses": self.misses, "hit_ratio": 0.0, "memory_bytes": 0}
+
+
+class FakeCache(CacheBackend):
+    """
+        In-memory stand-in for a shared backend in tests: no eviction nor expiry, records every
+        call in `calls` to assert on what was cached and invalidated
+    """
+
+    def __init__(self, maxsize=None, ttl=None):
+        self.data = {}
+        self.calls = []
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key):
+        self.calls.append(("get", key))
+        value = self.data.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key, value, ttl=None):
+        self.calls.append(("set", key))
+        self.data[key] = value
+
+    async def delete(self, key):
+        self.calls.append(("delete", key))
+        self.data.pop(key, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+            "memory_bytes": sum(len(value) for value in self.data.values()),
+        }
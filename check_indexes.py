@@ -0,0 +1,105 @@
+"""
+    Check that the hot order queries of the routes are planned on the indexes of the migrations
+
+    Runs EXPLAIN (Postgres, with sequential scans disabled so small tables don't hide a missing
+    index) or EXPLAIN QUERY PLAN (SQLite) on DATABASE_URL, exits 1 if a query isn't served by
+    its index. Run it after init_db.py, in CI or by hand: make check-indexes
+    The statements are built with the routes' filters: the psycopg2 engine sends parameters as
+    literals, the routes' asyncpg prepared statements don't, so the order statuses the partial
+    index depends on are inlined by the filters themselves
+"""
+import sys
+
+from sqlalchemy import select
+
+from crud import transition_filter
+from database import engine
+from models import Order
+from order_routes import order_filters
+from pagination import keyset
+from serializers import ORDER_COLUMNS
+
+
+PRIMARY_KEY = "<primary key>"
+
+# name, statement as the routes build it, indexes that may serve it
+HOT_QUERIES = (
+    (
+        "orders of a user (GET /orders/user/orders)",
+        select(*ORDER_COLUMNS).where(Order.user_id == 1),
+        {"ix_orders_user_id_id"},
+    ),
+    (
+        "order by id, on an order cache miss (GET /orders/{order_id}, /orders/user/order/{order_id})",
+        select(*ORDER_COLUMNS, Order.version).where(Order.id == 1),
+        {PRIMARY_KEY, "orders_pkey"},
+    ),
+    (
+        "page of a user's orders (GET /orders/all?user_id=)",
+        keyset(select(*ORDER_COLUMNS).where(Order.user_id == 1), Order.id, None, 50),
+        {"ix_orders_user_id_id"},
+    ),
+    (
+        "page of pending orders (GET /orders/all?order_status=PENDING)",
+        keyset(select(*ORDER_COLUMNS).where(*order_filters(order_status="PENDING")), Order.id, None, 50),
+        {"ix_orders_active_status"},
+    ),
+    (
+        "orders to dispatch (PUT /orders/order/status/bulk)",
+        select(Order.id).where(*order_filters(user_id=1), transition_filter("IN-TRANSIT")),
+        {"ix_orders_active_status", "ix_orders_user_id_id"},
+    ),
+)
+
+
+def explain(connection, statement):
+    """
+        Indexes used by the plan of a statement
+    """
+    compiled = statement.compile(dialect=connection.dialect)
+    # as the statement would bind them, e.g. pizza sizes as their integer codes
+    params = {}
+    for name, value in compiled.params.items():
+        processor = compiled.binds[name].type.bind_processor(connection.dialect)
+        params[name] = value if processor is None else processor(value)
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+
+    if connection.dialect.name == "postgresql":
+        plan = connection.exec_driver_sql("EXPLAIN (FORMAT JSON) " + str(compiled), params).scalar()
+        return set(plan_indexes(plan[0]["Plan"]))
+
+    indexes = set()
+    for row in connection.exec_driver_sql("EXPLAIN QUERY PLAN " + str(compiled), params):
+        detail = row[-1]
+        if "INTEGER PRIMARY KEY" in detail:
+            indexes.add(PRIMARY_KEY)
+        elif " INDEX " in detail:
+            indexes.add(detail.split(" INDEX ", 1)[1].split(" ", 1)[0])
+    return indexes
+
+
+def plan_indexes(node):
+    if "Index Name" in node:
+        yield node["Index Name"]
+    for child in node.get("Plans", ()):
+        yield from plan_indexes(child)
+
+
+def main():
+    failures = 0
+    with engine.connect() as connection:
+        if connection.dialect.name == "postgresql":
+            connection.exec_driver_sql("SET enable_seqscan = off")
+
+        for name, statement, expected in HOT_QUERIES:
+            used = explain(connection, statement)
+            ok = bool(used & expected)
+            failures += not ok
+            print("{} {}: {}".format("ok  " if ok else "FAIL", name, ", ".join(sorted(used)) or "full scan"))
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,220 @@
+import asyncio
+import random
+import warnings
+
+import environ
+from sqlalchemy import delete, func, select, text
+from sqlalchemy.dialects import postgresql, sqlite
+
+from database import AsyncSessionLocal
+from models import Order, OrderCounter
+
+
+env = environ.Env(DEBUG=(bool, False))
+environ.Env.read_env(".env")
+
+# Rows the totals are spread over, more slots let more order changes commit concurrently
+ORDER_COUNTER_SLOTS = env.int("ORDER_COUNTER_SLOTS", default=8)
+
+# Seconds between two reconciliations of the counters with the orders, 0 to disable
+ORDER_COUNTER_RECONCILE_INTERVAL = env.float("ORDER_COUNTER_RECONCILE_INTERVAL", default=3600)
+
+# user_id of the counters of every user
+ALL_USERS = 0
+
+# Slot holding the corrections of reconcile_counters, the order routes never write it
+RECONCILE_SLOT = -1
+
+# Postgres advisory lock taken by reconcile_counters, so the workers reconcile one at a time
+RECONCILE_LOCK_ID = 0x636f756e74657273
+
+COUNTER_KEY = ("user_id", "slot", "order_status", "pizza_size")
+
+DIALECT_INSERTS = {
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+}
+
+
+def count_order(deltas, user_id, order_status, pizza_size, quantity, sign=1):
+    """
+        Add (sign=1) or remove (sign=-1) an order from the counter deltas of its user and of ALL_USERS
+        deltas: {(user_id, order_status, pizza_size): [order_count, quantity]}
+        Orders without a status or a size aren't counted, as in reconcile_counters
+    """
+    if order_status is None or pizza_size is None:
+        return deltas
+
+    for counter_user in (ALL_USERS,) if user_id is None else (ALL_USERS, user_id):
+        delta = deltas.setdefault((counter_user, order_status, pizza_size), [0, 0])
+        delta[0] += sign
+        delta[1] += sign * (quantity or 0)
+    return deltas
+
+
+async def apply_counters(session, deltas, slot=None):
+    """
+        Add counter deltas in the current transaction, with a single upsert
+        The totals go to one slot picked at random, per-user counters to slot 0
+    """
+    rows = [
+        {
+            "user_id": user_id,
+            "slot": (random.randrange(ORDER_COUNTER_SLOTS) if slot is None else slot) if user_id == ALL_USERS else 0,
+            "order_status": order_status,
+            "pizza_size": pizza_size,
+            "order_count": order_count,
+            "quantity": quantity,
+        }
+        for (user_id, order_status, pizza_size), (order_count, quantity) in deltas.items()
+        if order_count or quantity
+    ]
+    if not rows:
+        return
+
+    # the upsert locks the counter rows in this order, the same for every transaction so two of
+    # them never wait on each other's rows
+    rows.sort(key=lambda row: tuple(row[column] for column in COUNTER_KEY))
+
+    statement = DIALECT_INSERTS[session.bind.dialect.name](OrderCounter).values(rows)
+    await session.execute(statement.on_conflict_do_update(
+        index_elements=COUNTER_KEY,
+        set_={
+            "order_count": OrderCounter.order_count + statement.excluded.order_count,
+            "quantity": OrderCounter.quantity + statement.excluded.quantity,
+        }
+    ))
+
+
+async def read_counters(session, user_id=ALL_USERS):
+    """
+        Counters of a user (or ALL_USERS), summed over their slots: [(order_status, pizza_size, order_count, quantity)]
+    """
+    rows = await session.execute(
+        select(
+            OrderCounter.order_status,
+            OrderCounter.pizza_size,
+            func.sum(OrderCounter.order_count),
+            func.sum(OrderCounter.quantity),
+        )
+        .where(OrderCounter.user_id == user_id)
+        .group_by(OrderCounter.order_status, OrderCounter.pizza_size)
+    )
+    return [tuple(row) for row in rows if row[2]]
+
+
+def summarize_counters(counters):
+    """
+        Dashboard shape of read_counters
+    """
+    summary = {"total": {"orders": 0, "quantity": 0}, "by_status": {}, "by_pizza_size": {}, "by_status_and_size": []}
+    for order_status, pizza_size, order_count, quantity in counters:
+        summary["total"]["orders"] += order_count
+        summary["total"]["quantity"] += quantity
+        for group, key in (("by_status", order_status), ("by_pizza_size", pizza_size)):
+            totals = summary[group].setdefault(key, {"orders": 0, "quantity": 0})
+            totals["orders"] += order_count
+            totals["quantity"] += quantity
+        summary["by_status_and_size"].append(
+            {"order_status": order_status, "pizza_size": pizza_size, "orders": order_count, "quantity": quantity}
+        )
+    return summary
+
+
+async def reconcile_counters(session):
+    """
+        Correct the drift between the counters and a GROUP BY of the orders
+        Both are read in one snapshot, and the difference is written to the RECONCILE_SLOT rows:
+        the order routes keep updating the other slots meanwhile, without waiting on the scan,
+        and running it again (from an older snapshot too) writes the same corrections
+        Return the number of counters corrected, None if another worker is reconciling them
+    """
+    if session.bind.dialect.name == "postgresql":
+        await session.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+        if not await session.scalar(text("SELECT pg_try_advisory_xact_lock(:lock_id)"), {"lock_id": RECONCILE_LOCK_ID}):
+            await session.rollback()
+            return None
+    else:
+        # SQLite has no snapshot across statements: a first write takes the database lock so no
+        # change commits between the two reads (writers queue there anyway), and drops zeroed corrections
+        await session.execute(
+            delete(OrderCounter)
+            .where(OrderCounter.slot == RECONCILE_SLOT, OrderCounter.order_count == 0, OrderCounter.quantity == 0)
+        )
+
+    actual = {}
+    orders = await session.execute(
+        select(Order.user_id, Order.order_status, Order.pizza_size, func.count(), func.sum(Order.quantity))
+        .where(Order.order_status.isnot(None), Order.pizza_size.isnot(None))
+        .group_by(Order.user_id, Order.order_status, Order.pizza_size)
+    )
+    for user_id, order_status, pizza_size, order_count, quantity in orders:
+        for counter_user in (ALL_USERS,) if user_id is None else (ALL_USERS, user_id):
+            total = actual.setdefault((counter_user, order_status, pizza_size), [0, 0])
+            total[0] += order_count
+            total[1] += quantity or 0
+
+    counted, corrections = {}, {}
+    is_correction = (OrderCounter.slot == RECONCILE_SLOT).label("is_correction")
+    counters = await session.execute(
+        select(
+            OrderCounter.user_id,
+            OrderCounter.order_status,
+            OrderCounter.pizza_size,
+            is_correction,
+            func.sum(OrderCounter.order_count),
+            func.sum(OrderCounter.quantity),
+        )
+        .group_by(OrderCounter.user_id, OrderCounter.order_status, OrderCounter.pizza_size, is_correction)
+    )
+    for user_id, order_status, pizza_size, is_correction, order_count, quantity in counters:
+        (corrections if is_correction else counted)[(user_id, order_status, pizza_size)] = (order_count, quantity)
+
+    rows = []
+    for key in actual.keys() | counted.keys() | corrections.keys():
+        order_count, quantity = actual.get(key, (0, 0))
+        counted_count, counted_quantity = counted.get(key, (0, 0))
+        correction = (order_count - counted_count, quantity - counted_quantity)
+        if correction != corrections.get(key, (0, 0)):
+            user_id, order_status, pizza_size = key
+            rows.append({
+                "user_id": user_id,
+                "slot": RECONCILE_SLOT,
+                "order_status": order_status,
+                "pizza_size": pizza_size,
+                "order_count": correction[0],
+                "quantity": correction[1],
+            })
+
+    if rows:
+        rows.sort(key=lambda row: tuple(row[column] for column in COUNTER_KEY))
+        statement = DIALECT_INSERTS[session.bind.dialect.name](OrderCounter).values(rows)
+        await session.execute(statement.on_conflict_do_update(
+            index_elements=COUNTER_KEY,
+            set_={"order_count": statement.excluded.order_count, "quantity": statement.excluded.quantity}
+        ))
+    await session.commit()
+    return len(rows)
+
+
+async def reconcile_periodically(interval=None):
+    """
+        Reconcile the counters every ORDER_COUNTER_RECONCILE_INTERVAL seconds, started with the app
+    """
+    interval = ORDER_COUNTER_RECONCILE_INTERVAL if interval is None else interval
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            async with AsyncSessionLocal() as session:
+                await reconcile_counters(session)
+        except Exception as e:
+            warnings.warn("Order counters reconciliation failed: {!r}".format(e))
+
+
+if __name__ == "__main__":
+    async def main():
+        async with AsyncSessionLocal() as session:
+            corrected = await reconcile_counters(session)
+            print("another reconciliation is running" if corrected is None else "{} counters corrected".format(corrected))
+
+    asyncio.run(main())
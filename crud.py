@@ -0,0 +1,92 @@
+from sqlalchemy import insert, select, update
+
+from models import Order
+
+
+ORDER_DEFAULTS = {
+    "order_status": "PENDING",
+    "pizza_size": "SMALL",
+}
+
+
+def validate_order(order, user_id):
+    """
+        Check an OrderModel and build the row to insert for it
+        Return (row, None) or (None, error message)
+    """
+    if order.quantity is None or order.quantity < 1:
+        return None, "Quantity must be at least 1"
+
+    order_status = order.order_status or ORDER_DEFAULTS["order_status"]
+    if order_status not in dict(Order.ORDER_STATUSES):
+        return None, "Invalid order status {}".format(order_status)
+
+    pizza_size = order.pizza_size or ORDER_DEFAULTS["pizza_size"]
+    if pizza_size not in dict(Order.PIZZA_SIZES):
+        return None, "Invalid pizza size {}".format(pizza_size)
+
+    return {
+        "quantity": order.quantity,
+        "order_status": order_status,
+        "pizza_size": pizza_size,
+        "user_id": user_id,
+    }, None
+
+
+async def insert_orders(session, rows):
+    """
+        Insert order rows in the current transaction, return their ids in the same order
+        A single multi-row INSERT ... RETURNING where the dialect supports it, one INSERT per
+        row otherwise (SQLite)
+    """
+    if not rows:
+        return []
+
+    if session.bind.dialect.full_returning:
+        result = await session.execute(insert(Order).values(rows).returning(Order.id))
+        return list(result.scalars())
+
+    ids = []
+    for row in rows:
+        result = await session.execute(insert(Order).values(**row))
+        ids.append(result.inserted_primary_key[0])
+    return ids
+
+
+def transition_filter(order_status):
+    """
+        Condition on the orders that can move to `order_status`, the statuses inlined so
+        ix_orders_active_status serves it
+    """
+    source = [current for current, following in Order.ORDER_TRANSITIONS.items() if following == order_status]
+    return Order.order_status.in_([Order.order_status.type.literal(current) for current in source])
+
+
+async def transition_orders(session, order_status, conditions):
+    """
+        Move the orders matching `conditions` to `order_status`, if they are in the status
+        before it (Order.ORDER_TRANSITIONS), in the current transaction, bumping their version
+        Return the (id, user_id, pizza_size, quantity) rows that changed
+        A single UPDATE ... RETURNING where the dialect supports it, SELECT then UPDATE otherwise
+    """
+    conditions = [*conditions, transition_filter(order_status)]
+
+    if session.bind.dialect.full_returning:
+        result = await session.execute(
+            update(Order)
+            .where(*conditions)
+            .values(order_status=order_status, version=Order.version + 1)
+            .returning(Order.id, Order.user_id, Order.pizza_size, Order.quantity)
+            .execution_options(synchronize_session=False)
+        )
+        return list(result)
+
+    rows = list(await session.execute(select(Order.id, Order.user_id, Order.pizza_size, Order.quantity).where(*conditions)))
+    if rows:
+        await session.execute(
+            update(Order)
+            .where(Order.id.in_([row.id for row in rows]), *conditions)
+            .values(order_status=order_status, version=Order.version + 1)
+            .execution_options(synchronize_session=False)
+        )
+    return rows
@@ -1,5 +1,11 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import declarative_base,sessionmaker
+import asyncio
+import time
+from contextvars import ContextVar
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import Session as OrmSession, declarative_base,sessionmaker
+from sqlalchemy.pool import QueuePool
 
 import environ
 
@@ -9,22 +15,210 @@ env = environ.Env(DEBUG=(bool, False))
 # Read router.env file
 environ.Env.read_env(".env")
 
-USER = env("POSTGRES_USER")
-PASSWORD = env("POSTGRES_PASSWORD")
-HOST = env("POSTGRES_HOST")
-PORT = env("POSTGRES_PORT")
-DATABASE = env("POSTGRES_DB")
-
-engine=create_engine('postgresql://{0}:{1}@{2}:{3}/{4}'.format(
-    USER,
-    PASSWORD,
-    HOST,
-    str(PORT),
-    DATABASE
-),
-    echo=True
-)
+# DATABASE_URL overrides the POSTGRES_* settings (e.g. sqlite:///./delivery.db for local runs)
+DATABASE_URL = env("DATABASE_URL", default=None)
+
+if DATABASE_URL is None:
+    USER = env("POSTGRES_USER")
+    PASSWORD = env("POSTGRES_PASSWORD")
+    HOST = env("POSTGRES_HOST")
+    PORT = env("POSTGRES_PORT")
+    DATABASE = env("POSTGRES_DB")
+
+    DATABASE_URL = 'postgresql://{0}:{1}@{2}:{3}/{4}'.format(
+        USER,
+        PASSWORD,
+        HOST,
+        str(PORT),
+        DATABASE
+    )
+
+# asyncio drivers used by the request handlers
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def async_url(url):
+    """
+        Swap the driver of a database url for its asyncio counterpart
+        - postgresql://... -> postgresql+asyncpg://...
+        - sqlite://... -> sqlite+aiosqlite://...
+    """
+    scheme, rest = url.split("://", 1)
+    backend = scheme.split("+", 1)[0]
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError("No asyncio driver configured for {}".format(backend))
+
+    return "{}://{}".format(ASYNC_DRIVERS[backend], rest)
+
+
+ASYNC_DATABASE_URL = env("ASYNC_DATABASE_URL", default=None) or async_url(DATABASE_URL)
+
+# Connection pool, sized per worker process
+POOL_SIZE = env.int("DB_POOL_SIZE", default=5)
+MAX_OVERFLOW = env.int("DB_MAX_OVERFLOW", default=10)
+POOL_TIMEOUT = env.float("DB_POOL_TIMEOUT", default=30)
+POOL_RECYCLE = env.int("DB_POOL_RECYCLE", default=1800)
+POOL_PRE_PING = env.bool("DB_POOL_PRE_PING", default=True)
+ECHO = env.bool("DB_ECHO", default=False)
+
+# Connections opened per worker at startup, so the first requests don't pay for them
+POOL_WARMUP = env.int("DB_POOL_WARMUP", default=POOL_SIZE)
+
+
+def engine_options(url):
+    """
+        Keyword arguments for create_engine/create_async_engine
+        Pool settings only apply to servers, SQLite doesn't use a QueuePool
+    """
+    options = {"echo": ECHO}
+
+    if not url.startswith("sqlite"):
+        options.update(
+            pool_size=POOL_SIZE,
+            max_overflow=MAX_OVERFLOW,
+            pool_timeout=POOL_TIMEOUT,
+            pool_recycle=POOL_RECYCLE,
+            pool_pre_ping=POOL_PRE_PING,
+        )
+
+    return options
+
+
+# Synchronous engine, used by init_db and scripts
+engine=create_engine(DATABASE_URL, **engine_options(DATABASE_URL))
+
+# asyncio engine, used by the request handlers
+async_engine=create_async_engine(ASYNC_DATABASE_URL, future=True, **engine_options(ASYNC_DATABASE_URL))
 
 Base=declarative_base()
 
-Session=sessionmaker()
\ No newline at end of file
+Session=sessionmaker(bind=engine)
+
+
+class PrimarySession(OrmSession):
+    """
+        Session class of the request sessions on the primary, replicas.py tracks their writes
+    """
+
+
+# expire_on_commit=False: attributes can't be lazily reloaded outside of an await
+AsyncSessionLocal=sessionmaker(bind=async_engine, class_=AsyncSession, sync_session_class=PrimarySession, expire_on_commit=False)
+
+
+async def get_db():
+    """
+        Request-scoped session dependency
+        The session is closed (and any failed transaction rolled back) when the request ends
+    """
+    async with AsyncSessionLocal() as session:
+        yield session
+
+
+async def warm_pool(connections=None):
+    """
+        Open pool connections ahead of the first requests, at most the pool size
+        Fails the startup when the database can't be reached
+    """
+    pool = async_engine.sync_engine.pool
+    if not isinstance(pool, QueuePool):
+        return 0
+
+    connections = min(POOL_WARMUP if connections is None else connections, pool.size())
+
+    async def connect():
+        connection = await async_engine.connect()
+        await connection.execute(text("SELECT 1"))
+        return connection
+
+    # all held at once, or the pool would hand out the same connection every time
+    connected = await asyncio.gather(*(connect() for _ in range(connections)))
+    for connection in connected:
+        await connection.close()
+
+    return connections
+
+
+async def dispose_engines():
+    """
+        Close the pooled connections on shutdown, instead of leaving them to the server to time out
+    """
+    await async_engine.dispose()
+    engine.dispose()
+
+
+# Pool saturation counters
+_pool_stats = {"checkouts": 0, "peak_checked_out": 0}
+
+
+@event.listens_for(async_engine.sync_engine, "checkout")
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    pool = async_engine.sync_engine.pool
+    _pool_stats["checkouts"] += 1
+    checked_out = pool.checkedout() if hasattr(pool, "checkedout") else 0
+    if checked_out > _pool_stats["peak_checked_out"]:
+        _pool_stats["peak_checked_out"] = checked_out
+
+
+def pool_status():
+    """
+        Snapshot of the connection pool, used to size DB_POOL_SIZE/DB_MAX_OVERFLOW per worker
+    """
+    pool = async_engine.sync_engine.pool
+    stats = {
+        "pool_class": type(pool).__name__,
+        "checkouts": _pool_stats["checkouts"],
+        "peak_checked_out": _pool_stats["peak_checked_out"],
+    }
+
+    if hasattr(pool, "checkedout"):
+        capacity = pool.size() + MAX_OVERFLOW
+        stats.update(
+            size=pool.size(),
+            max_overflow=MAX_OVERFLOW,
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+            saturation=round(pool.checkedout() / capacity, 3) if capacity else 0.0,
+        )
+
+    return stats
+
+
+# [query count, seconds] of the request being served, set by metrics.MetricsMiddleware
+current_queries = ContextVar("current_queries", default=None)
+
+# SQL of every statement run by the request being served, set by query_budget.QueryBudgetMiddleware
+current_statements = ContextVar("current_statements", default=None)
+
+# id of the authenticated user of the request being served, set by security.get_current_user
+current_user_id = ContextVar("current_user_id", default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    statements = current_statements.get()
+    if statements is not None:
+        statements.append(statement)
+    if current_queries.get() is not None and context is not None:
+        context._query_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    queries = current_queries.get()
+    started = getattr(context, "_query_started", None)
+    if queries is not None and started is not None:
+        queries[0] += 1
+        queries[1] += time.perf_counter() - started
+
+
+def instrument(async_engine):
+    """
+        Count the queries of an asyncio engine in current_queries/current_statements
+    """
+    event.listen(async_engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(async_engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+
+
+instrument(async_engine)
@@ -0,0 +1,78 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException, status
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, generate_password_hash, check_password_hash
+import environ
+
+
+env = environ.Env(DEBUG=(bool, False))
+environ.Env.read_env(".env")
+
+# werkzeug method string, "<algorithm>:<hash>:<iterations>" for pbkdf2
+PASSWORD_HASH_METHOD = env("PASSWORD_HASH_METHOD", default="pbkdf2:sha256:260000")
+PASSWORD_HASH_WORKERS = env.int("PASSWORD_HASH_WORKERS", default=min(4, os.cpu_count() or 1))
+# Hash/verify calls allowed to run or wait per worker process before answering 503
+PASSWORD_HASH_QUEUE = env.int("PASSWORD_HASH_QUEUE", default=64)
+
+# hashlib releases the GIL while deriving keys, so threads are enough to use several cores
+executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+
+_pending = 0
+
+
+async def run_hashing(fn, *args):
+    """
+        Run a hashing call in the executor, failing fast once PASSWORD_HASH_QUEUE calls are pending
+    """
+    global _pending
+
+    if _pending >= PASSWORD_HASH_QUEUE:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many password checks in progress, retry later",
+            headers={"Retry-After": "1"}
+        )
+
+    _pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+    finally:
+        _pending -= 1
+
+
+async def hash_password(password):
+    return await run_hashing(generate_password_hash, password, PASSWORD_HASH_METHOD)
+
+
+async def verify_password(password_hash, password):
+    return await run_hashing(check_password_hash, password_hash, password)
+
+
+def hash_prefix(method):
+    """
+        Method werkzeug writes before the salt of the hashes it makes: pbkdf2 without an iteration
+        count gets the default one, e.g. pbkdf2:sha512 is written pbkdf2:sha512:260000
+    """
+    if method.startswith("pbkdf2:") and method.count(":") == 1:
+        return "{}:{}".format(method, DEFAULT_PBKDF2_ITERATIONS)
+    return method
+
+
+PASSWORD_HASH_PREFIX = hash_prefix(PASSWORD_HASH_METHOD)
+
+
+def needs_rehash(password_hash):
+    """
+        Whether a stored hash was made with other parameters than PASSWORD_HASH_METHOD
+    """
+    return password_hash.split("$", 1)[0] != PASSWORD_HASH_PREFIX
+
+
+def hashing_stats():
+    return {
+        "workers": PASSWORD_HASH_WORKERS,
+        "queue_limit": PASSWORD_HASH_QUEUE,
+        "pending": _pending,
+    }
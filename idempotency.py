@@ -0,0 +1,195 @@
+import asyncio
+import hashlib
+import warnings
+from datetime import datetime, timedelta
+from typing import Optional
+
+import environ
+import orjson
+from fastapi import Depends, Header, HTTPException, Request, Response, status
+from sqlalchemy import and_, delete, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from counters import DIALECT_INSERTS
+from database import AsyncSessionLocal, get_db
+from models import IdempotencyKey
+from security import CurrentUser, get_current_user
+
+
+env = environ.Env(DEBUG=(bool, False))
+environ.Env.read_env(".env")
+
+# How long a retry with the same Idempotency-Key gets the stored response back
+IDEMPOTENCY_KEY_TTL = env.float("IDEMPOTENCY_KEY_TTL", default=86400)
+
+# Seconds after which a key whose first request never answered (worker killed) can be used again
+IDEMPOTENCY_LOCK_TIMEOUT = env.float("IDEMPOTENCY_LOCK_TIMEOUT", default=60)
+
+# Seconds between two purges of the expired keys, 0 to disable
+IDEMPOTENCY_PURGE_INTERVAL = env.float("IDEMPOTENCY_PURGE_INTERVAL", default=3600)
+
+MAX_KEY_LENGTH = 255
+
+# Statements a request with a key runs on top of the route's: claiming the key, then storing the
+# response or dropping the key
+IDEMPOTENCY_QUERIES = 2
+
+# Response headers kept with the body, the others are rebuilt on replay
+STORED_HEADERS = ("content-type", "etag", "cache-control")
+
+
+class IdempotentRequest:
+    """
+        Idempotency-Key of a request, and the response stored for it by an earlier try
+    """
+
+    __slots__ = ("session", "user_id", "key", "fingerprint", "stored", "saved")
+
+    def __init__(self, session=None, user_id=None, key=None, fingerprint=None, stored=None):
+        self.session = session
+        self.user_id = user_id
+        self.key = key
+        self.fingerprint = fingerprint
+        self.stored = stored
+        self.saved = False
+
+    def replay(self):
+        """
+            The stored response, None if the request has to be served
+        """
+        if self.stored is None:
+            return None
+
+        return Response(
+            self.stored.body.encode(),
+            status_code=self.stored.status_code,
+            headers={**orjson.loads(self.stored.headers), "Idempotent-Replayed": "true"},
+        )
+
+    def where(self):
+        return and_(IdempotencyKey.user_id == self.user_id, IdempotencyKey.key == self.key)
+
+    async def save(self, response):
+        """
+            Store a successful response for the retries, and return it
+        """
+        if self.key is not None and 200 <= response.status_code < 300:
+            await self.session.execute(update(IdempotencyKey).where(self.where()).values(
+                created_at=datetime.utcnow(),
+                status_code=response.status_code,
+                headers=orjson.dumps({name: response.headers[name] for name in STORED_HEADERS if name in response.headers}).decode(),
+                body=response.body.decode(),
+            ))
+            await self.session.commit()
+            self.saved = True
+        return response
+
+    async def release(self):
+        """
+            Drop the key of a request that didn't succeed, so it can be retried with it
+        """
+        await self.session.rollback()
+        await self.session.execute(delete(IdempotencyKey).where(
+            self.where(), IdempotencyKey.fingerprint == self.fingerprint, IdempotencyKey.status_code.is_(None)
+        ))
+        await self.session.commit()
+
+
+async def claim_key(session, user_id, key, fingerprint):
+    """
+        Insert the key before serving the request, the primary key makes it a lock across workers
+        Return the IdempotentRequest, with the stored response if an earlier try succeeded
+    """
+    idempotent = IdempotentRequest(session, user_id, key, fingerprint)
+    now = datetime.utcnow()
+
+    statement = DIALECT_INSERTS[session.bind.dialect.name](IdempotencyKey).values(
+        user_id=user_id, key=key, fingerprint=fingerprint, created_at=now
+    )
+    claimed = (await session.execute(statement.on_conflict_do_nothing())).rowcount
+    if not claimed:
+        # expired, or left in flight by a worker that never answered
+        claimed = (await session.execute(
+            update(IdempotencyKey)
+            .where(idempotent.where(), or_(
+                IdempotencyKey.created_at < now - timedelta(seconds=IDEMPOTENCY_KEY_TTL),
+                and_(
+                    IdempotencyKey.status_code.is_(None),
+                    IdempotencyKey.created_at < now - timedelta(seconds=IDEMPOTENCY_LOCK_TIMEOUT),
+                ),
+            ))
+            .values(fingerprint=fingerprint, created_at=now, status_code=None, headers=None, body=None)
+        )).rowcount
+    if claimed:
+        # visible to the other workers before the request is served
+        await session.commit()
+        return idempotent
+
+    stored = await session.scalar(select(IdempotencyKey).where(idempotent.where()))
+    await session.commit()
+    if stored is not None and stored.fingerprint != fingerprint:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Idempotency-Key was already used for another request")
+    if stored is None or stored.status_code is None:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="A request with this Idempotency-Key is in progress, retry", headers={"Retry-After": "1"})
+
+    idempotent.stored = stored
+    return idempotent
+
+
+async def idempotency(
+    request: Request,
+    idempotency_key: Optional[str] = Header(None),
+    user:CurrentUser=Depends(get_current_user),
+    session:AsyncSession=Depends(get_db)
+):
+    """
+        Dependency of the routes accepting an Idempotency-Key header
+        - a retry of a request that succeeded gets its response back, without running the handler's queries
+        - 422 if the key was used for a different request (method, path or body)
+        - 409 while the first request with the key is still being served, by any worker
+    """
+    if idempotency_key is None:
+        yield IdempotentRequest()
+        return
+
+    if not 0 < len(idempotency_key) <= MAX_KEY_LENGTH:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Idempotency-Key must be 1 to {} characters".format(MAX_KEY_LENGTH))
+
+    fingerprint = hashlib.sha256(b"\n".join((
+        request.method.encode(), request.url.path.encode(), request.url.query.encode(), await request.body()
+    ))).hexdigest()
+
+    idempotent = await claim_key(session, user.id, idempotency_key, fingerprint)
+    if idempotent.stored is not None:
+        yield idempotent
+        return
+
+    try:
+        yield idempotent
+    finally:
+        if not idempotent.saved:
+            await idempotent.release()
+
+
+async def purge_keys(session):
+    """
+        Delete the keys past IDEMPOTENCY_KEY_TTL, return how many
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=max(IDEMPOTENCY_KEY_TTL, IDEMPOTENCY_LOCK_TIMEOUT))
+    deleted = (await session.execute(delete(IdempotencyKey).where(IdempotencyKey.created_at < cutoff))).rowcount
+    await session.commit()
+    return deleted
+
+
+async def purge_periodically(interval=None):
+    """
+        Purge the expired keys every IDEMPOTENCY_PURGE_INTERVAL seconds, started with the app
+    """
+    interval = IDEMPOTENCY_PURGE_INTERVAL if interval is None else interval
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            async with AsyncSessionLocal() as session:
+                await purge_keys(session)
+        except Exception as e:
+            warnings.warn("Idempotency keys purge failed: {!r}".format(e))
@@ -1,4 +1,17 @@
-from database import engine, Base
-from models import User, Order
+import os
 
-Base.metadata.create_all(bind=engine)
\ No newline at end of file
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import inspect
+
+from database import engine
+
+
+config = Config(os.path.join(os.path.dirname(os.path.abspath(__file__)), "alembic.ini"))
+
+# Databases made by the former create_all have the initial schema but no migration history
+tables = inspect(engine).get_table_names()
+if "users" in tables and "alembic_version" not in tables:
+    command.stamp(config, "0001")
+
+command.upgrade(config, "head")
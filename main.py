@@ -1,15 +1,52 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import ORJSONResponse
 from auth_routes import auth_router
 from order_routes import order_router
 from fastapi_jwt_auth import AuthJWT
 from schemas import Settings
-import inspect, re
-from fastapi.routing import APIRoute
+from database import dispose_engines, pool_status, warm_pool
+from security import cache_stats
+from hashing import hashing_stats
+from pubsub import broker
+from order_cache import order_cache
+from idempotency import IDEMPOTENCY_PURGE_INTERVAL, purge_periodically
+from ratelimit import admission_stats
+from batcher import ORDER_BATCHING, order_batcher
+from counters import ORDER_COUNTER_RECONCILE_INTERVAL, reconcile_periodically
+from replicas import REPLICA_HEALTH_INTERVAL, check_replicas, dispose_replicas, monitor_replicas, replica_status
+import asyncio
+from metrics import MetricsMiddleware, render as render_metrics
+from query_budget import QUERY_BUDGET_MODE, QueryBudgetMiddleware
+import hashlib, json, os
+from fastapi.openapi.docs import get_redoc_html, get_swagger_ui_html
 from fastapi.openapi.utils import get_openapi
+import environ
+
+# variables from environment
+env = environ.Env(DEBUG=(bool, False))
+
+# Read router.env file
+environ.Env.read_env(".env")
+
+# Pre-built schema (python main.py openapi <path>), served as is instead of being generated
+OPENAPI_SCHEMA_PATH = env("OPENAPI_SCHEMA_PATH", default=None)
+OPENAPI_URL = "/openapi.json"
 
 # app = FastAPI()
-app = FastAPI(swagger_ui_parameters={"syntaxHighlight": False})
-app = FastAPI(swagger_ui_parameters={"syntaxHighlight.theme": "obsidian"})
+# app = FastAPI(swagger_ui_parameters={"syntaxHighlight": False})
+# openapi_url=None: the schema and docs are served below from the cached document
+app = FastAPI(
+    swagger_ui_parameters={"syntaxHighlight.theme": "obsidian"},
+    openapi_url=None,
+    default_response_class=ORJSONResponse
+)
+
+# Per-route latency, sizes and query counts, exported on /metrics
+app.add_middleware(MetricsMiddleware)
+
+# Development/test check of the SQL statements each route runs against its query_budget
+if QUERY_BUDGET_MODE != "off":
+    app.add_middleware(QueryBudgetMiddleware)
 
 
 def custom_openapi():
@@ -35,6 +72,7 @@ def custom_openapi():
        },
     }
 
+    # Routes declare their requirement through security.bearer_scheme
     openapi_schema["components"]["securitySchemes"] = {
         "Bearer Auth": {
             "type": "http",
@@ -46,34 +84,122 @@ def custom_openapi():
         }
     }
 
-    # Get all routes where jwt_optional() or jwt_required
-    api_router = [route for route in app.routes if isinstance(route, APIRoute)]
+    app.openapi_schema = openapi_schema
+    return app.openapi_schema
+
 
-    for route in api_router:
-        path = getattr(route, "path")
-        endpoint = getattr(route,"endpoint")
-        methods = [method.lower() for method in getattr(route, "methods")]
+app.openapi = custom_openapi
 
+# Serialized schema and its ETag
+openapi_document = {}
 
 
-        for method in methods:
-            # access_token
-            if (
-                re.search("jwt_required", inspect.getsource(endpoint)) or
-                re.search("fresh_jwt_required", inspect.getsource(endpoint)) or
-                re.search("jwt_optional", inspect.getsource(endpoint))
-            ):
-                openapi_schema["paths"][path][method]["security"] = [
-                    {
-                        "Bearer Auth": []
-                    }
-                ]
+def build_openapi_document():
+    """
+        Serialize the schema once per worker, or load the pre-built one
+    """
+    if OPENAPI_SCHEMA_PATH and os.path.exists(OPENAPI_SCHEMA_PATH):
+        with open(OPENAPI_SCHEMA_PATH, "rb") as schema_file:
+            body = schema_file.read()
+    else:
+        body = json.dumps(app.openapi()).encode()
 
-    app.openapi_schema = openapi_schema
-    return app.openapi_schema
+    openapi_document["body"] = body
+    openapi_document["etag"] = '"{}"'.format(hashlib.sha256(body).hexdigest()[:32])
+    return openapi_document
 
 
-app.openapi = custom_openapi
+@app.on_event("startup")
+async def startup_openapi():
+    build_openapi_document()
+
+
+@app.on_event("startup")
+async def startup_pubsub():
+    await broker.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_pubsub():
+    await broker.stop()
+
+
+@app.on_event("startup")
+async def startup_batcher():
+    if ORDER_BATCHING:
+        order_batcher.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_batcher():
+    await order_batcher.stop()
+
+
+# Background reconciliation of the order counters (counters.py), purge of the expired idempotency
+# keys (idempotency.py) and replica health checks (replicas.py)
+background_tasks = set()
+
+
+@app.on_event("startup")
+async def startup_counters():
+    if ORDER_COUNTER_RECONCILE_INTERVAL > 0:
+        background_tasks.add(asyncio.create_task(reconcile_periodically()))
+
+
+@app.on_event("startup")
+async def startup_idempotency():
+    if IDEMPOTENCY_PURGE_INTERVAL > 0:
+        background_tasks.add(asyncio.create_task(purge_periodically()))
+
+
+@app.on_event("shutdown")
+async def shutdown_counters():
+    for task in background_tasks:
+        task.cancel()
+
+
+@app.on_event("startup")
+async def startup_replicas():
+    await check_replicas()
+    if REPLICA_HEALTH_INTERVAL > 0:
+        background_tasks.add(asyncio.create_task(monitor_replicas()))
+
+
+@app.on_event("startup")
+async def startup_db():
+    await warm_pool()
+
+
+# registered last, runs once the other shutdown hooks are done with the database
+@app.on_event("shutdown")
+async def shutdown_db():
+    await dispose_replicas()
+    await dispose_engines()
+
+
+@app.get(OPENAPI_URL, include_in_schema=False)
+async def openapi_json(request: Request):
+    document = openapi_document or build_openapi_document()
+    headers = {"ETag": document["etag"], "Cache-Control": "no-cache"}
+
+    if request.headers.get("if-none-match") == document["etag"]:
+        return Response(status_code=304, headers=headers)
+
+    return Response(document["body"], media_type="application/json", headers=headers)
+
+
+@app.get("/docs", include_in_schema=False)
+async def swagger_ui_html():
+    return get_swagger_ui_html(
+        openapi_url=OPENAPI_URL,
+        title=app.title + " - Swagger UI",
+        swagger_ui_parameters=app.swagger_ui_parameters
+    )
+
+
+@app.get("/redoc", include_in_schema=False)
+async def redoc_html():
+    return get_redoc_html(openapi_url=OPENAPI_URL, title=app.title + " - ReDoc")
 
 @AuthJWT.load_config
 def get_config():
@@ -82,17 +208,110 @@ def get_config():
 app.include_router(auth_router, prefix="/api")
 app.include_router(order_router, prefix="/api")
 
+
+@app.get("/api/health/pool", include_in_schema=False)
+async def health_pool():
+    """
+        Connection pool saturation for this worker
+    """
+    return pool_status()
+
+
+@app.get("/api/health/replicas", include_in_schema=False)
+async def health_replicas():
+    """
+        Health and lag of the read replicas, as of their last check
+    """
+    return replica_status()
+
+
+def all_cache_stats():
+    return {**cache_stats(), "order": order_cache.stats()}
+
+
+@app.get("/api/health/cache", include_in_schema=False)
+async def health_cache():
+    """
+        Hit/miss counters and memory of the identity and order caches for this worker
+    """
+    return all_cache_stats()
+
+
+@app.get("/api/health/hashing", include_in_schema=False)
+async def health_hashing():
+    """
+        Password hashing pool usage for this worker
+    """
+    return hashing_stats()
+
+
+@app.get("/api/health/admission", include_in_schema=False)
+async def health_admission():
+    """
+        Requests served, waiting and shed, and rate limited clients for this worker
+    """
+    return admission_stats()
+
+
+@app.get("/api/health/batcher", include_in_schema=False)
+async def health_batcher():
+    """
+        Orders created by the batcher and average batch size for this worker
+    """
+    return order_batcher.stats()
+
+
+@app.get("/api/health/pubsub", include_in_schema=False)
+async def health_pubsub():
+    """
+        Order update subscribers of this worker
+    """
+    return broker.stats()
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """
+        Prometheus metrics of this worker
+    """
+    return Response(
+        render_metrics(pool_status(), all_cache_stats(), hashing_stats(), broker.stats()),
+        media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
 if __name__ == "__main__":
+    import sys
     import uvicorn
-    import environ
 
-    # variables from environment
-    env = environ.Env(DEBUG=(bool, False))
+    # python main.py openapi <path>: write the schema served with OPENAPI_SCHEMA_PATH
+    if sys.argv[1:2] == ["openapi"]:
+        path = sys.argv[2] if len(sys.argv) > 2 else "openapi.json"
+        with open(path, "w") as schema_file:
+            json.dump(app.openapi(), schema_file)
+        sys.exit(0)
 
-    # Read router.env file
-    environ.Env.read_env(".env")
     HOST = env("HOST", default="0.0.0.0")
-    PORT = env("PORT", default=8000)
-    RELOAD = env("RELOAD", default=True)
+    PORT = env.int("PORT", default=8000)
+
+    # "dev": one process reloading on changes, "prod": WORKERS processes, uvloop and httptools
+    RUN_MODE = env("RUN_MODE", default="dev")
+
+    if RUN_MODE == "prod":
+        # the workers read it too, e.g. the order cache is off by default with several
+        os.environ["WORKERS"] = str(env.int("WORKERS", default=os.cpu_count() or 1))
 
-    uvicorn.run("__main__:app", host=HOST, port=PORT, reload=RELOAD)
\ No newline at end of file
+        # each worker has its own pool: up to WORKERS * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections
+        uvicorn.run(
+            "main:app",
+            host=HOST,
+            port=PORT,
+            workers=int(os.environ["WORKERS"]),
+            loop=env("LOOP", default="uvloop"),
+            http=env("HTTP", default="httptools"),
+            backlog=env.int("BACKLOG", default=2048),
+            timeout_keep_alive=env.int("KEEP_ALIVE", default=5),
+            access_log=env.bool("ACCESS_LOG", default=False),
+            forwarded_allow_ips=env("FORWARDED_ALLOW_IPS", default="127.0.0.1"),
+        )
+    else:
+        uvicorn.run("__main__:app", host=HOST, port=PORT, reload=env.bool("RELOAD", default=True))
@@ -0,0 +1,210 @@
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from database import current_queries
+
+
+# Latency buckets in seconds, and queries-per-request buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# Requests that didn't match a route share one label, so scanners can't blow up the series count
+UNMATCHED_ROUTE = "<unmatched>"
+
+
+class Histogram:
+    """
+        Prometheus histogram, one series per label tuple
+        observe() is a bisect and two additions, buckets are made cumulative when rendered
+    """
+
+    def __init__(self, name, documentation, labelnames, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def observe(self, labels, value):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} histogram".format(self.name)]
+        for labels, (counts, total) in self._series.items():
+            label_text = format_labels(self.labelnames, labels)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                bucket_labels = format_labels(self.labelnames + ("le",), labels + (format_value(bound),))
+                lines.append("{}_bucket{} {}".format(self.name, bucket_labels, cumulative))
+            lines.append("{}_sum{} {}".format(self.name, label_text, format_value(total)))
+            lines.append("{}_count{} {}".format(self.name, label_text, cumulative))
+        return lines
+
+
+class Counter:
+    """
+        Prometheus counter (or gauge, with inc(-1)), one value per label tuple
+    """
+
+    def __init__(self, name, documentation, labelnames, kind="counter"):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.kind = kind
+        self._values = defaultdict(float)
+
+    def inc(self, labels, amount=1):
+        self._values[labels] += amount
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} {}".format(self.name, self.kind)]
+        for labels, value in self._values.items():
+            lines.append("{}{} {}".format(self.name, format_labels(self.labelnames, labels), format_value(value)))
+        return lines
+
+
+def format_value(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+             for name, value in zip(names, values))
+    return "{" + ",".join(pairs) + "}"
+
+
+REQUEST_LABELS = ("method", "route", "status")
+ROUTE_LABELS = ("method", "route")
+
+request_duration = Histogram(
+    "http_request_duration_seconds", "Time to serve a request, until its last body chunk is sent",
+    REQUEST_LABELS, LATENCY_BUCKETS
+)
+request_size = Counter("http_request_size_bytes_total", "Request body bytes received", ROUTE_LABELS)
+response_size = Counter("http_response_size_bytes_total", "Response body bytes sent", REQUEST_LABELS)
+requests_in_progress = Counter("http_requests_in_progress", "Requests being served", ("method",), kind="gauge")
+request_queries = Histogram(
+    "http_request_db_queries", "Database queries run per request", ROUTE_LABELS, QUERY_BUCKETS
+)
+request_db_seconds = Counter("http_request_db_seconds_total", "Time spent running database queries", ROUTE_LABELS)
+
+HTTP_METRICS = (request_duration, request_size, response_size, requests_in_progress, request_queries, request_db_seconds)
+
+
+class MetricsMiddleware:
+    """
+        Pure ASGI middleware recording the metrics of every HTTP request
+        The route label is the path template of the matched route (/api/orders/{order_id}),
+        resolved from the endpoint the router stores in the scope
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._route_paths = None
+
+    def route_path(self, scope):
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return UNMATCHED_ROUTE
+
+        if self._route_paths is None:
+            self._route_paths = {
+                route.endpoint: route.path
+                for route in scope["app"].routes
+                if hasattr(route, "endpoint") and hasattr(route, "path")
+            }
+        return self._route_paths.get(endpoint, UNMATCHED_ROUTE)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        sizes = [0, 0]
+        response_status = [500]
+        queries = [0, 0.0]
+
+        async def receive_wrapper():
+            message = await receive()
+            if message["type"] == "http.request":
+                sizes[0] += len(message.get("body", b""))
+            return message
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                response_status[0] = message["status"]
+            elif message["type"] == "http.response.body":
+                sizes[1] += len(message.get("body", b""))
+            await send(message)
+
+        token = current_queries.set(queries)
+        requests_in_progress.inc((method,))
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            requests_in_progress.inc((method,), -1)
+            current_queries.reset(token)
+
+            route = self.route_path(scope)
+            status = str(response_status[0])
+            request_duration.observe((method, route, status), elapsed)
+            request_size.inc((method, route), sizes[0])
+            response_size.inc((method, route, status), sizes[1])
+            request_queries.observe((method, route), queries[0])
+            request_db_seconds.inc((method, route), queries[1])
+
+
+def gauge_lines(name, documentation, values, kind="gauge"):
+    """
+        Render a flat {label: value} snapshot (pool, caches, hashing) as one metric family
+    """
+    lines = ["# HELP {} {}".format(name, documentation), "# TYPE {} {}".format(name, kind)]
+    for labels, value in values:
+        lines.append("{}{} {}".format(name, labels, format_value(value)))
+    return lines
+
+
+def render(pool, caches, hashing, pubsub):
+    """
+        Prometheus text exposition of the HTTP metrics and the pool/cache/hashing/pubsub snapshots
+    """
+    lines = []
+    for metric in HTTP_METRICS:
+        lines.extend(metric.render())
+
+    lines.extend(gauge_lines("db_pool", "Connection pool snapshot of this worker", [
+        (format_labels(("stat",), (stat,)), value)
+        for stat, value in pool.items() if isinstance(value, (int, float))
+    ]))
+    lines.extend(gauge_lines("cache", "Cache snapshot of this worker", [
+        (format_labels(("cache", "stat"), (cache, stat)), value)
+        for cache, stats in caches.items() for stat, value in stats.items() if isinstance(value, (int, float))
+    ]))
+    lines.extend(gauge_lines("password_hashing", "Password hashing pool snapshot of this worker", [
+        (format_labels(("stat",), (stat,)), value)
+        for stat, value in hashing.items() if isinstance(value, (int, float))
+    ]))
+    lines.extend(gauge_lines("pubsub", "Order update subscriptions of this worker", [
+        (format_labels(("stat",), (stat,)), value)
+        for stat, value in pubsub.items() if isinstance(value, (int, float))
+    ]))
+
+    return "\n".join(lines) + "\n"
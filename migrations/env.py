@@ -0,0 +1,51 @@
+from logging.config import fileConfig
+
+from alembic import context
+
+from database import DATABASE_URL, Base, engine
+import models
+
+
+config = context.config
+
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+
+target_metadata = Base.metadata
+
+# SQLite can't ALTER most things in place, batch mode recreates the table instead
+render_as_batch = DATABASE_URL.startswith("sqlite")
+
+
+def run_migrations_offline():
+    """
+        Emit the SQL instead of running it (alembic upgrade head --sql)
+    """
+    context.configure(
+        url=DATABASE_URL,
+        target_metadata=target_metadata,
+        literal_binds=True,
+        dialect_opts={"paramstyle": "named"},
+        render_as_batch=render_as_batch,
+    )
+
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    with engine.connect() as connection:
+        context.configure(
+            connection=connection,
+            target_metadata=target_metadata,
+            render_as_batch=render_as_batch,
+        )
+
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,41 @@
+"""users and orders tables, as created by the former init_db create_all
+
+Revision ID: 0001
+Revises:
+Create Date: 2022-12-20
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "users",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("username", sa.String(length=25), unique=True),
+        sa.Column("email", sa.String(length=80), unique=True),
+        sa.Column("password", sa.Text(), nullable=True),
+        sa.Column("is_staff", sa.Boolean()),
+        sa.Column("is_active", sa.Boolean()),
+    )
+
+    # order_status and pizza_size are sqlalchemy_utils ChoiceType columns, stored as Unicode(255)
+    op.create_table(
+        "orders",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("quantity", sa.Integer(), nullable=False),
+        sa.Column("order_status", sa.Unicode(length=255)),
+        sa.Column("pizza_size", sa.Unicode(length=255)),
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id")),
+    )
+
+
+def downgrade():
+    op.drop_table("orders")
+    op.drop_table("users")
@@ -0,0 +1,37 @@
+"""indexes for the order lookups of the routes
+
+- (user_id, id): a user's orders in id order, and the ownership checks (id + user_id)
+- (order_status, id) on the orders still moving: status filters and keyset pages of the
+  dispatch routes, delivered orders (most of the table) stay out of it. Written as OR terms:
+  SQLite only uses a partial index when a query term appears as is in its WHERE, not in an IN list
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2022-12-20
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+ACTIVE_STATUSES = sa.text("order_status = 'PENDING' OR order_status = 'IN-TRANSIT'")
+
+
+def upgrade():
+    op.create_index("ix_orders_user_id_id", "orders", ["user_id", "id"])
+    op.create_index(
+        "ix_orders_active_status",
+        "orders",
+        ["order_status", "id"],
+        postgresql_where=ACTIVE_STATUSES,
+        sqlite_where=ACTIVE_STATUSES,
+    )
+
+
+def downgrade():
+    op.drop_index("ix_orders_active_status", table_name="orders")
+    op.drop_index("ix_orders_user_id_id", table_name="orders")
@@ -0,0 +1,23 @@
+"""row version of orders, used for ETags and optimistic concurrency
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2022-12-21
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("orders", sa.Column("version", sa.Integer(), nullable=False, server_default="1"))
+
+
+def downgrade():
+    with op.batch_alter_table("orders") as batch_op:
+        batch_op.drop_column("version")
@@ -0,0 +1,46 @@
+"""order counters of the staff dashboard, filled from the existing orders
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2022-12-22
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "order_counters",
+        sa.Column("user_id", sa.Integer(), primary_key=True, autoincrement=False),
+        sa.Column("slot", sa.Integer(), primary_key=True, autoincrement=False),
+        sa.Column("order_status", sa.String(length=255), primary_key=True),
+        sa.Column("pizza_size", sa.String(length=255), primary_key=True),
+        sa.Column("order_count", sa.Integer(), nullable=False),
+        sa.Column("quantity", sa.Integer(), nullable=False),
+    )
+
+    # per user, then the totals (user_id 0) in slot 0
+    op.execute("""
+        INSERT INTO order_counters (user_id, slot, order_status, pizza_size, order_count, quantity)
+        SELECT user_id, 0, order_status, pizza_size, COUNT(*), COALESCE(SUM(quantity), 0)
+        FROM orders
+        WHERE user_id IS NOT NULL AND order_status IS NOT NULL AND pizza_size IS NOT NULL
+        GROUP BY user_id, order_status, pizza_size
+    """)
+    op.execute("""
+        INSERT INTO order_counters (user_id, slot, order_status, pizza_size, order_count, quantity)
+        SELECT 0, 0, order_status, pizza_size, COUNT(*), COALESCE(SUM(quantity), 0)
+        FROM orders
+        WHERE order_status IS NOT NULL AND pizza_size IS NOT NULL
+        GROUP BY order_status, pizza_size
+    """)
+
+
+def downgrade():
+    op.drop_table("order_counters")
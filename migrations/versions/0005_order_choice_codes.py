@@ -0,0 +1,88 @@
+"""order status and pizza size stored as small integer codes instead of strings
+
+Converts the existing rows with the codes of models.Order (ORDER_STATUS_CODES, PIZZA_SIZE_CODES),
+copied here so later changes to the model don't change this migration. Fails without changing
+anything if a row holds a value with no code. The partial index on the active statuses is
+rebuilt on the codes.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2022-12-23
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+CODES = {
+    "order_status": (("PENDING", 1), ("IN-TRANSIT", 2), ("DELIVERED", 3)),
+    "pizza_size": (("SMALL", 1), ("MEDIUM", 2), ("LARGE", 3), ("EXTRA-LARGE", 4)),
+}
+
+ACTIVE_STRINGS = sa.text("order_status = 'PENDING' OR order_status = 'IN-TRANSIT'")
+ACTIVE_CODES = sa.text("order_status = 1 OR order_status = 2")
+
+
+def case(column, pairs):
+    """
+        CASE mapping the values of a column, as strings while the column is still a string column
+    """
+    whens = " ".join("WHEN '{}' THEN '{}'".format(old, new) for old, new in pairs)
+    return "CASE {} {} END".format(column, whens)
+
+
+def create_active_index(predicate):
+    op.create_index(
+        "ix_orders_active_status",
+        "orders",
+        ["order_status", "id"],
+        postgresql_where=predicate,
+        sqlite_where=predicate,
+    )
+
+
+def upgrade():
+    connection = op.get_bind()
+    for column, pairs in CODES.items():
+        unknown = connection.execute(sa.text(
+            "SELECT DISTINCT {0} FROM orders WHERE {0} IS NOT NULL AND {0} NOT IN ({1})".format(
+                column, ", ".join("'{}'".format(choice) for choice, code in pairs)
+            )
+        )).scalars().all()
+        if unknown:
+            raise RuntimeError("orders.{} holds values with no code: {}".format(column, ", ".join(unknown)))
+
+    op.drop_index("ix_orders_active_status", table_name="orders")
+    op.execute("UPDATE orders SET {}".format(", ".join(
+        "{} = {}".format(column, case(column, pairs)) for column, pairs in CODES.items()
+    )))
+    with op.batch_alter_table("orders") as batch_op:
+        for column in CODES:
+            batch_op.alter_column(
+                column,
+                existing_type=sa.Unicode(length=255),
+                type_=sa.SmallInteger(),
+                postgresql_using="{}::smallint".format(column),
+            )
+    create_active_index(ACTIVE_CODES)
+
+
+def downgrade():
+    op.drop_index("ix_orders_active_status", table_name="orders")
+    with op.batch_alter_table("orders") as batch_op:
+        for column in CODES:
+            batch_op.alter_column(
+                column,
+                existing_type=sa.SmallInteger(),
+                type_=sa.Unicode(length=255),
+                postgresql_using="{}::varchar".format(column),
+            )
+    op.execute("UPDATE orders SET {}".format(", ".join(
+        "{} = {}".format(column, case(column, [(str(code), choice) for choice, code in pairs]))
+        for column, pairs in CODES.items()
+    )))
+    create_active_index(ACTIVE_STRINGS)
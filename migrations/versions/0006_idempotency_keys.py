@@ -0,0 +1,31 @@
+"""idempotency keys and their stored responses, shared by the workers
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2022-12-24
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "idempotency_keys",
+        sa.Column("user_id", sa.Integer(), primary_key=True, autoincrement=False),
+        sa.Column("key", sa.String(length=255), primary_key=True),
+        sa.Column("fingerprint", sa.String(length=64), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("status_code", sa.Integer(), nullable=True),
+        sa.Column("headers", sa.Text(), nullable=True),
+        sa.Column("body", sa.Text(), nullable=True),
+    )
+
+
+def downgrade():
+    op.drop_table("idempotency_keys")
@@ -1,7 +1,40 @@
 from database import Base
-from sqlalchemy import Column,Integer,Boolean,Text,String,ForeignKey
+from sqlalchemy import Column,Integer,Boolean,Text,String,ForeignKey,Index,SmallInteger,DateTime,literal_column,text
 from sqlalchemy.orm import relationship
-from sqlalchemy_utils.types import ChoiceType
+from sqlalchemy.types import TypeDecorator
+
+
+class CodedChoice(TypeDecorator):
+    """
+        Choice column stored as a small integer, read and written as its string code
+        codes: ((choice, integer), ...), new choices get new integers, stored ones never change
+    """
+    impl=SmallInteger
+    cache_ok=True
+
+    def __init__(self,codes):
+        super().__init__()
+        self.codes=codes
+        self.to_integer=dict(codes)
+        self.to_choice={integer:choice for choice,integer in codes}
+
+    def process_bind_param(self,value,dialect):
+        if value is None:
+            return None
+        try:
+            return self.to_integer[value]
+        except KeyError:
+            raise ValueError("{!r} is not one of {}".format(value, ", ".join(self.to_integer)))
+
+    def process_result_value(self,value,dialect):
+        return None if value is None else self.to_choice[value]
+
+    def literal(self,choice):
+        """
+            The integer of a choice written in the SQL instead of bound: asyncpg prepares statements
+            and Postgres may plan them for any value, then it can't use a partial index on the column
+        """
+        return literal_column(str(self.process_bind_param(choice,None)),self)
 
 
 class User(Base):
@@ -28,6 +61,12 @@ class Order(Base):
 
     )
 
+    # status -> the status it can move to
+    ORDER_TRANSITIONS={
+        'PENDING':'IN-TRANSIT',
+        'IN-TRANSIT':'DELIVERED'
+    }
+
     PIZZA_SIZES=(
         ('SMALL','small'),
         ('MEDIUM','medium'),
@@ -35,14 +74,72 @@ class Order(Base):
         ('EXTRA-LARGE','extra-large')
     )
 
+    # Stored integer of each choice, the data migration 0005_order_choice_codes converted the strings with them
+    ORDER_STATUS_CODES=(('PENDING',1),('IN-TRANSIT',2),('DELIVERED',3))
+    PIZZA_SIZE_CODES=(('SMALL',1),('MEDIUM',2),('LARGE',3),('EXTRA-LARGE',4))
+
 
     __tablename__='orders'
     id=Column(Integer,primary_key=True)
     quantity=Column(Integer,nullable=False)
-    order_status=Column(ChoiceType(choices=ORDER_STATUSES),default="PENDING")
-    pizza_size=Column(ChoiceType(choices=PIZZA_SIZES),default="SMALL")
+    order_status=Column(CodedChoice(ORDER_STATUS_CODES),default="PENDING")
+    pizza_size=Column(CodedChoice(PIZZA_SIZE_CODES),default="SMALL")
     user_id=Column(Integer,ForeignKey('users.id'))
+    # Row version, bumped by every UPDATE, the ETag of the order
+    version=Column(Integer,nullable=False,server_default='1')
     users=relationship('User',back_populates='orders')   
 
+    # The ORM checks and bumps version on flush, a concurrent change raises StaleDataError
+    __mapper_args__={'version_id_col':version}
+
+    # Created by migrations/versions/0002_order_indexes.py, the partial one on codes since 0005
+    __table_args__=(
+        Index('ix_orders_user_id_id','user_id','id'),
+        Index(
+            'ix_orders_active_status','order_status','id',
+            postgresql_where=text("order_status = 1 OR order_status = 2"),
+            sqlite_where=text("order_status = 1 OR order_status = 2")
+        ),
+    )
+
+    def __repr__(self):
+        return f"<Order {self.id}>"
+
+
+class OrderCounter(Base):
+    """
+        Order count and total quantity per user, status and pizza size, kept up to date by the
+        order routes in the transaction of each change (counters.py)
+        user_id 0 holds the totals of every user, spread over ORDER_COUNTER_SLOTS rows so
+        concurrent writers don't queue on one row
+    """
+    __tablename__='order_counters'
+    user_id=Column(Integer,primary_key=True,autoincrement=False)
+    slot=Column(Integer,primary_key=True,autoincrement=False)
+    order_status=Column(String(255),primary_key=True)
+    pizza_size=Column(String(255),primary_key=True)
+    order_count=Column(Integer,nullable=False,default=0)
+    quantity=Column(Integer,nullable=False,default=0)
+
+    def __repr__(self):
+        return f"<OrderCounter {self.user_id} {self.order_status} {self.pizza_size}>"
+
+
+class IdempotencyKey(Base):
+    """
+        Idempotency-Key of a user's request (idempotency.py), shared by the workers
+        Inserted before the request is served, so a concurrent retry finds it, then completed with
+        the response; status_code is NULL while the first request is in flight
+    """
+    __tablename__='idempotency_keys'
+    user_id=Column(Integer,primary_key=True,autoincrement=False)
+    key=Column(String(255),primary_key=True)
+    fingerprint=Column(String(64),nullable=False)
+    # When the key was claimed, then when the response was stored
+    created_at=Column(DateTime,nullable=False)
+    status_code=Column(Integer)
+    headers=Column(Text)
+    body=Column(Text)
+
     def __repr__(self):
-        return f"<Order {self.id}>"
\ No newline at end of file
+        return f"<IdempotencyKey {self.user_id} {self.key}>"
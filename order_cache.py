@@ -0,0 +1,87 @@
+import warnings
+
+import environ
+import orjson
+from sqlalchemy import select
+
+from cache import load_backend
+from models import Order
+from replicas import REPLICA_MAX_LAG
+from serializers import ORDER_COLUMNS, order_etag, serialize_order
+
+
+env = environ.Env(DEBUG=(bool, False))
+environ.Env.read_env(".env")
+
+# Worker processes serving the app, exported by `make start-prod`, set it with another process manager
+WORKERS = env.int("WORKERS", default=1)
+
+# Dotted path of the CacheBackend class, cache.FakeCache in tests, a shared store with several workers
+# A LocalCache never sees the invalidations of the other workers, so with several none is cached by default
+ORDER_CACHE_BACKEND = env("ORDER_CACHE_BACKEND", default="cache.LocalCache" if WORKERS == 1 else "cache.NullCache")
+
+# Also bounds how long another worker's LocalCache can serve an order changed elsewhere
+ORDER_CACHE_TTL = env.float("ORDER_CACHE_TTL", default=60)
+ORDER_CACHE_SIZE = env.int("ORDER_CACHE_SIZE", default=10000)
+
+
+if WORKERS > 1 and ORDER_CACHE_BACKEND == "cache.LocalCache":
+    warnings.warn("ORDER_CACHE_BACKEND=cache.LocalCache with {} workers: an order changed by one worker is served stale by the others for up to ORDER_CACHE_TTL seconds".format(WORKERS))
+
+order_cache = load_backend(ORDER_CACHE_BACKEND, maxsize=ORDER_CACHE_SIZE, ttl=ORDER_CACHE_TTL)
+
+
+def order_key(order_id):
+    return "order:{}".format(order_id)
+
+
+# reads of this worker loading an order from the database, by key: a flag per read, set when the
+# order is invalidated meanwhile, so the read doesn't cache what it loaded before the change
+loading = {}
+
+
+async def get_cached_order(session, order_id, refresh=False):
+    """
+        {"etag": ..., "order": serialized order} of an order, read through order_cache, or None
+        refresh reads it from the session even if it's cached, for users who must see their writes:
+        the cached copy may come from a replica that didn't have them yet
+    """
+    key = order_key(order_id)
+    if not refresh:
+        value = await order_cache.get(key)
+        if value is not None:
+            return orjson.loads(value)
+
+    invalidated = [False]
+    loading.setdefault(key, []).append(invalidated)
+    try:
+        row = (await session.execute(select(*ORDER_COLUMNS, Order.version).where(Order.id == order_id))).first()
+    finally:
+        reads = loading[key]
+        reads.remove(invalidated)
+        if not reads:
+            del loading[key]
+
+    if row is None:
+        return None
+
+    entry = {"etag": order_etag(row), "order": serialize_order(row)}
+    if not invalidated[0]:
+        # a replica may not have the last change yet, that copy mustn't outlive the lag it's allowed
+        ttl = min(ORDER_CACHE_TTL, REPLICA_MAX_LAG) if session.info.get("replica") else None
+        await order_cache.set(key, orjson.dumps(entry), ttl=ttl)
+    return entry
+
+
+async def invalidate_orders(order_ids):
+    """
+        Drop cached orders, after committing a change to them
+        The reads of this worker still loading them won't cache them: they may have read them before
+        the change. Other workers' reads aren't told, with a shared backend they can still cache
+        what they read before the change, until the entry expires
+    """
+    for order_id in order_ids:
+        key = order_key(order_id)
+        for invalidated in loading.get(key, ()):
+            invalidated[0] = True
+        await order_cache.delete(key)
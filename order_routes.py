@@ -1,203 +1,394 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from schemas import OrderModel, OrderStatusModel, UpdateOrderModel
-from models import User, Order
-from werkzeug.security import generate_password_hash, check_password_hash
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response, WebSocket, status
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi_jwt_auth import AuthJWT
-from fastapi.encoders import jsonable_encoder
-from database import Session, engine
+from typing import List, Optional
+import asyncio, csv, io, time
+import orjson
+from schemas import BulkOrderStatusModel, OrderModel, OrderStatusModel, UpdateOrderModel
+from models import Order
+from sqlalchemy import select
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import AsyncSessionLocal, get_db
+from crud import ORDER_DEFAULTS, insert_orders, transition_orders, validate_order
+from counters import ALL_USERS, apply_counters, count_order, read_counters, summarize_counters
+from security import CurrentUser, get_current_user, user_from_claims
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, keyset, page
+from serializers import ORDER_COLUMNS, etag_matches, order_etag, serialize_order
+from pubsub import broker, user_topic
+from order_cache import get_cached_order, invalidate_orders
+from query_budget import query_budget
+from ratelimit import admission, check_rate_limits
+from replicas import get_read_db, mark_write, wrote_recently
+from batcher import ORDER_BATCHING, order_batcher
+from idempotency import IDEMPOTENCY_QUERIES, IdempotentRequest, idempotency
 
 order_router = APIRouter(
     prefix="/orders",
     tags=["orders"],
+    dependencies=[Depends(admission)],
 )
 
-session = Session(bind=engine)
+MAX_BULK_ORDERS = 1000
+EXPORT_COLUMNS = ("order_id", "quantity", "order_status", "pizza_size", "user_id")
+EXPORT_CHUNK_SIZE = 1000
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def check_choices(order_status=None, pizza_size=None):
+    """
+        422 on an order status or pizza size the orders table has no code for
+    """
+    if order_status is not None and order_status not in dict(Order.ORDER_STATUSES):
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Invalid order status")
+    if pizza_size is not None and pizza_size not in dict(Order.PIZZA_SIZES):
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Invalid pizza size")
+
+
+def order_filters(order_status=None, pizza_size=None, user_id=None):
+    """
+        Conditions for the optional order filters of the staff routes
+    """
+    check_choices(order_status, pizza_size)
+    conditions = []
+    if order_status is not None:
+        # inlined, for ix_orders_active_status to serve the PENDING and IN-TRANSIT pages
+        conditions.append(Order.order_status == Order.order_status.type.literal(order_status))
+    if pizza_size is not None:
+        conditions.append(Order.pizza_size == pizza_size)
+    if user_id is not None:
+        conditions.append(Order.user_id == user_id)
+
+    return conditions
+
+
+def order_response(order, etag, if_none_match=None, status_code=status.HTTP_200_OK):
+    """
+        A serialized order with its ETag, or an empty 304 when the client's copy (If-None-Match) is current
+    """
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    return ORJSONResponse(order, status_code=status_code, headers=headers)
+
+
+def check_if_match(order, if_match):
+    """
+        412 when the client changes an order from an outdated copy (If-Match)
+    """
+    if if_match is not None and not etag_matches(if_match, order_etag(order), weak=False):
+        raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED, detail="Order has changed, get it again")
+
+
+async def commit_order(session, if_match=None):
+    """
+        Commit a change of a loaded order, the version check fails if another request changed it meanwhile
+    """
+    try:
+        await session.commit()
+    except StaleDataError:
+        await session.rollback()
+        if if_match is not None:
+            raise HTTPException(status_code=status.HTTP_412_PRECONDITION_FAILED, detail="Order has changed, get it again")
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Order was changed by another request, retry")
+
 
 @order_router.get("/all", status_code=status.HTTP_200_OK)
-async def order(Authorize:AuthJWT=Depends()):
+@query_budget(2)
+async def order(
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    order_status: Optional[str] = None,
+    pizza_size: Optional[str] = None,
+    user_id: Optional[int] = None,
+    user:CurrentUser=Depends(get_current_user),
+    session:AsyncSession=Depends(get_read_db)
+):
     """
         ## Get all orders
-        Return a list of all orders
+        Return a page of orders, ordered by id
         Only superuser can access this route
+        - On Query:
+            - limit: int (default 50, max 500)
+            - cursor: str, the next_cursor of the previous page
+            - order_status: str
+            - pizza_size: str
+            - user_id: int
     """
 
-    try:
-        Authorize.jwt_required()
-    except Exception as e:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid Token [UnAuthorized]")
-
-    current_user = Authorize.get_jwt_subject()
-    user = session.query(User).filter(User.username == current_user).first()
     if user.is_staff:
-        all_orders = session.query(Order).all()
-        response = []
-        for order in all_orders:
-            response.append({
-                "order_id": order.id,
-                "quantity": order.quantity,
-                "order_status": order.order_status.code,
-                "pizza_size": order.pizza_size.code,
-                "user_id": order.user_id
-            })
-
-        return jsonable_encoder(response)
+        statement = select(*ORDER_COLUMNS).where(*order_filters(order_status, pizza_size, user_id))
+        orders = await session.execute(keyset(statement, Order.id, cursor, limit))
+        response = [serialize_order(order) for order in orders]
+
+        return ORJSONResponse(page(response, limit, "order_id"))
     
     raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You are not Superuser")
 
+async def export_rows(statement, format, session):
+    """
+        Encode the orders of a select in chunks, read through a server-side cursor
+        Streams through the request's session: dependencies are only closed once the response is sent
+    """
+    if format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+        yield buffer.getvalue()
+
+    result = await session.stream(statement.execution_options(yield_per=EXPORT_CHUNK_SIZE))
+
+    async for rows in result.partitions(EXPORT_CHUNK_SIZE):
+        if format == "csv":
+            buffer.seek(0)
+            buffer.truncate()
+            for row in rows:
+                writer.writerow(serialize_order(row).values())
+            yield buffer.getvalue()
+        else:
+            yield b"".join(orjson.dumps(serialize_order(row)) + b"\n" for row in rows)
+
+
+# Export orders
+@order_router.get("/export", status_code=status.HTTP_200_OK)
+@query_budget(2)
+async def export_orders(
+    format: str = Query("ndjson", regex="^(ndjson|csv)$"),
+    order_status: Optional[str] = None,
+    pizza_size: Optional[str] = None,
+    user_id: Optional[int] = None,
+    user:CurrentUser=Depends(get_current_user),
+    session:AsyncSession=Depends(get_read_db)
+):
+    """
+        ## Export orders
+        Stream every order as NDJSON or CSV, memory stays flat whatever the table size
+        Only superuser can access this route
+        - On Query:
+            - format: str, ndjson (default) or csv
+            - order_status: str
+            - pizza_size: str
+            - user_id: int
+    """
+
+    if user.is_staff:
+        statement = (
+            select(*ORDER_COLUMNS)
+            .where(*order_filters(order_status, pizza_size, user_id))
+            .order_by(Order.id)
+        )
+
+        return StreamingResponse(
+            export_rows(statement, format, session),
+            media_type=EXPORT_MEDIA_TYPES[format],
+            headers={"Content-Disposition": "attachment; filename=orders.{}".format(format)}
+        )
+
+    raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You are not Superuser")
+
+# Order statistics
+@order_router.get("/stats", status_code=status.HTTP_200_OK)
+@query_budget(2)
+async def order_stats(user_id: Optional[int] = None, user:CurrentUser=Depends(get_current_user), session:AsyncSession=Depends(get_read_db)):
+    """
+        ## Order statistics
+        Order count and total quantity by status and pizza size, read from counters that every
+        order change keeps up to date, so the cost doesn't grow with the number of orders
+        Only superuser can access this route
+        - On Query:
+            - user_id: int, the statistics of one user
+    """
+
+    if user.is_staff:
+        counters = await read_counters(session, ALL_USERS if user_id is None else user_id)
+        return ORJSONResponse(summarize_counters(counters))
+
+    raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You are not Superuser")
+
 # create orders
 @order_router.post("/order", status_code=status.HTTP_201_CREATED)
-async def create_order(order: OrderModel, Authorize:AuthJWT=Depends()):
+@query_budget(3 + IDEMPOTENCY_QUERIES)
+async def create_order(order: OrderModel, idempotent:IdempotentRequest=Depends(idempotency), user:CurrentUser=Depends(get_current_user), session:AsyncSession=Depends(get_db)):
     """
         ## Create new order
         Any user can create new order with
         body:
             - quantity: int
             - pizza_size: str
+        - On Header:
+            - Idempotency-Key: a retry with the same key and body gets the first response back
+        With ORDER_BATCHING, the order is inserted in a transaction shared with concurrent requests
     """
-    try:
-        Authorize.jwt_required()
-    except Exception as e:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid Token [UnAuthorized]")
-    
-    current_user = Authorize.get_jwt_subject()
-    db_user = session.query(User).filter(User.username == current_user).first()
+    replayed = idempotent.replay()
+    if replayed is not None:
+        return replayed
+
+    check_choices(order.order_status, order.pizza_size)
+
+    if ORDER_BATCHING:
+        row = {
+            "quantity": order.quantity,
+            "order_status": order.order_status or ORDER_DEFAULTS["order_status"],
+            "pizza_size": order.pizza_size or ORDER_DEFAULTS["pizza_size"],
+            "user_id": user.id
+        }
+        # committed by the batcher's task, outside of this request's session: give back the
+        # connection the auth lookup may have left it, so waiting requests don't starve the batcher
+        await session.close()
+        order_id = await order_batcher.insert(row)
+        mark_write(user.id)
+
+        return await idempotent.save(ORJSONResponse(serialize_order(Order(id=order_id, **row)), status_code=status.HTTP_201_CREATED))
+
     new_order = Order(
         quantity=order.quantity,
         order_status=order.order_status,
         pizza_size=order.pizza_size,
-        user_id=db_user.id
+        user_id=user.id
     )
-    new_order.users = db_user
     session.add(new_order)
-    session.commit()
+    await apply_counters(session, count_order(
+        {},
+        user.id,
+        order.order_status or ORDER_DEFAULTS["order_status"],
+        order.pizza_size or ORDER_DEFAULTS["pizza_size"],
+        order.quantity
+    ))
+    await session.commit()
+
+    return await idempotent.save(ORJSONResponse(serialize_order(new_order), status_code=status.HTTP_201_CREATED))
+
+# create many orders at once
+@order_router.post("/order/bulk", status_code=status.HTTP_201_CREATED)
+# SQLite has no multi-row RETURNING, orders are inserted one by one there
+@query_budget(MAX_BULK_ORDERS + 2, repeats=MAX_BULK_ORDERS)
+async def create_orders(orders: List[OrderModel], user:CurrentUser=Depends(get_current_user), session:AsyncSession=Depends(get_db)):
+    """
+        ## Create many orders
+        Insert a list of orders in one transaction
+        Invalid items are reported in errors, the valid ones are still created
+        body: list of (up to 1000)
+            - quantity: int
+            - pizza_size: str
+    """
+    if len(orders) > MAX_BULK_ORDERS:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="At most {} orders per request".format(MAX_BULK_ORDERS))
+
+    rows, indexes, errors = [], [], []
+    for index, order in enumerate(orders):
+        row, error = validate_order(order, user.id)
+        if error is None:
+            rows.append(row)
+            indexes.append(index)
+        else:
+            errors.append({"index": index, "detail": error})
+
+    order_ids = await insert_orders(session, rows)
+
+    deltas = {}
+    for row in rows:
+        count_order(deltas, user.id, row["order_status"], row["pizza_size"], row["quantity"])
+    await apply_counters(session, deltas)
+    await session.commit()
 
     response = {
-        "order_id": new_order.id,
-        "quantity": new_order.quantity,
-        "order_status": new_order.order_status.code,
-        "pizza_size": new_order.pizza_size.code,
-        "user_id": new_order.user_id
+        "orders": [
+            {"index": index, "order_id": order_id, **row}
+            for index, order_id, row in zip(indexes, order_ids, rows)
+        ],
+        "errors": errors
     }
 
-
-    return jsonable_encoder(response)
+    return ORJSONResponse(response, status_code=status.HTTP_201_CREATED)
 
 # Get One Order by ID
 @order_router.get("/{order_id}", status_code=status.HTTP_200_OK)
-async def get_order(order_id: int, Authorize:AuthJWT=Depends()):
+@query_budget(2)
+async def get_order(order_id: int, if_none_match: Optional[str] = Header(None), user:CurrentUser=Depends(get_current_user), session:AsyncSession=Depends(get_read_db)):
     """
         ## Get order by ID
-        Return a single order
+        Return a single order, with its ETag
         - On Route:
             - order_id: int
+        - On Header:
+            - If-None-Match: the ETag of your copy, 304 without body if it's still current
     """
 
-    try:
-        Authorize.jwt_required()
-    except Exception as e:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid Token [UnAuthorized]")
-    
-    current_user = Authorize.get_jwt_subject()
-    db_user = session.query(User).filter(User.username == current_user).first()
-    db_order = session.query(Order).filter(Order.id == order_id).first()
-    if db_order is None:
+    cached = await get_cached_order(session, order_id, refresh=wrote_recently(user.id))
+    if cached is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Order not found")
     
-    if db_user.is_staff or db_user.id == db_order.user_id:
-        response = {
-            "order_id": db_order.id,
-            "quantity": db_order.quantity,
-            "order_status": db_order.order_status.code,
-            "pizza_size": db_order.pizza_size.code,
-            "user_id": db_order.user_id
-        }
-        return jsonable_encoder(response)
+    if user.is_staff or user.id == cached["order"]["user_id"]:
+        return order_response(cached["order"], cached["etag"], if_none_match)
     
     raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You don't have permission to access this order")
 
 # Get all orders for the current user
 @order_router.get("/user/orders", status_code=status.HTTP_200_OK)
-async def get_my_orders(Authorize:AuthJWT=Depends()):
+@query_budget(2)
+async def get_my_orders(user:CurrentUser=Depends(get_current_user), session:AsyncSession=Depends(get_read_db)):
     """
         ## Get all orders for the current user
         Return a list of all orders
     """
 
-    try:
-        Authorize.jwt_required()
-    except Exception as e:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid Token [UnAuthorized]")
-    current_user = Authorize.get_jwt_subject()
-    user = session.query(User).filter(User.username == current_user).first()
-
-    response = []
-    for order in user.orders:
-        response.append({
-            "order_id": order.id,
-            "quantity": order.quantity,
-            "order_status": order.order_status.code,
-            "pizza_size": order.pizza_size.code,
-            "user_id": order.user_id
-        })
+    orders = await session.execute(select(*ORDER_COLUMNS).where(Order.user_id == user.id))
 
-    return jsonable_encoder(response)
+    return ORJSONResponse([serialize_order(order) for order in orders])
 
 # Get a single order for the current user
 @order_router.get("/user/order/{order_id}", status_code=status.HTTP_200_OK)
-async def get_my_order(order_id: int, Authorize:AuthJWT=Depends()):
+@query_budget(2)
+async def get_my_order(order_id: int, if_none_match: Optional[str] = Header(None), user:CurrentUser=Depends(get_current_user), session:AsyncSession=Depends(get_read_db)):
     """
         ## Get a single order for the current user
+        Return the order with its ETag
         - On Route:
             - order_id: int
+        - On Header:
+            - If-None-Match: the ETag of your copy, 304 without body if it's still current
     """
 
-    try:
-        Authorize.jwt_required()
-    except Exception as e:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid Token [UnAuthorized]")
+    cached = await get_cached_order(session, order_id, refresh=wrote_recently(user.id))
 
-    current_user = Authorize.get_jwt_subject()
-    user = session.query(User).filter(User.username == current_user).first()
-    orders = user.orders
-    
-    for order in orders:
-        if order.id == order_id:
-            response = {
-                "order_id": order.id,
-                "quantity": order.quantity,
-                "order_status": order.order_status.code,
-                "pizza_size": order.pizza_size.code,
-                "user_id": order.user_id
-            }
-            return jsonable_encoder(response)
+    if cached is not None and cached["order"]["user_id"] == user.id:
+        return order_response(cached["order"], cached["etag"], if_none_match)
     
     raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not order found for this user")
 
 # Update an order by id
 @order_router.patch("/order/update/{order_id}", status_code=status.HTTP_202_ACCEPTED)
-async def patch_order(update_order: UpdateOrderModel, order_id:int, Authorize:AuthJWT=Depends()):
+@query_budget(4 + IDEMPOTENCY_QUERIES)
+async def patch_order(update_order: UpdateOrderModel, order_id:int, if_match: Optional[str] = Header(None), idempotent:IdempotentRequest=Depends(idempotency), user:CurrentUser=Depends(get_current_user), session:AsyncSession=Depends(get_db)):
     """
         ## Update an order by id
         You can only update the order if its status is pending
         - On route:
             - order_id: int
+        - On Header:
+            - If-Match: the ETag of the order you changed, 412 if it has changed since
+            - Idempotency-Key: a retry with the same key and body gets the first response back
         - Body: UpdateOrderModel
             - quantity: int
             - pizza_size: str
     """
-    try:
-        Authorize.jwt_required()
-    except Exception as e:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid Token [UnAuthorized]")
-    
-    current_user = Authorize.get_jwt_subject()
-    user = session.query(User).filter(User.username == current_user).first()
-    order = session.query(Order).filter(Order.id == order_id).first()
+    replayed = idempotent.replay()
+    if replayed is not None:
+        return replayed
+
+    check_choices(pizza_size=update_order.pizza_size)
+
+    order = await session.scalar(select(Order).where(Order.id == order_id))
 
     if order is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Order not found")
 
     if order.user_id == user.id:
+        check_if_match(order, if_match)
+
+        deltas = count_order({}, order.user_id, order.order_status, order.pizza_size, order.quantity, sign=-1)
+
         # update order (Just Quantity and Pizza Size Only if the order is pending)
         if order.order_status == "PENDING":
             if update_order.quantity is not None:
@@ -205,59 +396,127 @@ async def patch_order(update_order: UpdateOrderModel, order_id:int, Authorize:Au
             if update_order.pizza_size is not None:
                 order.pizza_size = update_order.pizza_size
         else:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You can't update this order becouse is {}".format(order.order_status.code))
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You can't update this order becouse is {}".format(order.order_status))
 
-        session.commit()
-    
-        response = {
-            "order_id": order.id,
-            "quantity": order.quantity,
-            "order_status": order.order_status.code,
-            "pizza_size": order.pizza_size.code,
-            "user_id": order.user_id
-        }
-        return jsonable_encoder(response)
+        await apply_counters(session, count_order(deltas, order.user_id, order.order_status, order.pizza_size, order.quantity))
+        await commit_order(session, if_match)
+        await invalidate_orders([order.id])
+
+        return await idempotent.save(order_response(serialize_order(order), order_etag(order), status_code=status.HTTP_202_ACCEPTED))
     
     raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You don't have permission to update this order")
 
+# Update the status of many orders
+@order_router.put("/order/status/bulk", status_code=status.HTTP_200_OK)
+@query_budget(5)
+async def put_orders_status(update_orders: BulkOrderStatusModel, user:CurrentUser=Depends(get_current_user), session:AsyncSession=Depends(get_db)):
+    """
+        ## Update the status of many orders
+        Only staff can update order status
+        Orders only move forward: PENDING -> IN-TRANSIT -> DELIVERED
+        - Body: BulkOrderStatusModel
+            - order_status: str, the new status
+            - order_ids: list of int (up to 1000)
+            - or a filter: pizza_size: str, user_id: int
+        Return the ids that changed, that don't exist and that can't move to order_status
+    """
+    if not user.is_staff:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You don't have permission to update status")
+
+    if update_orders.order_status not in Order.ORDER_TRANSITIONS.values():
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Orders can't move to {}".format(update_orders.order_status))
+
+    if update_orders.order_ids is None and update_orders.pizza_size is None and update_orders.user_id is None:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Give order_ids or a filter")
+
+    if update_orders.order_ids is not None and len(update_orders.order_ids) > MAX_BULK_ORDERS:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="At most {} orders per request".format(MAX_BULK_ORDERS))
+
+    conditions = order_filters(pizza_size=update_orders.pizza_size, user_id=update_orders.user_id)
+    if update_orders.order_ids is not None:
+        conditions.append(Order.id.in_(update_orders.order_ids))
+
+    changed = await transition_orders(session, update_orders.order_status, conditions)
+    updated = [row.id for row in changed]
+
+    # ORDER_TRANSITIONS is a chain, each status is reached from a single one
+    previous_status = next(current for current, following in Order.ORDER_TRANSITIONS.items() if following == update_orders.order_status)
+    deltas = {}
+    for row in changed:
+        count_order(deltas, row.user_id, previous_status, row.pizza_size, row.quantity, sign=-1)
+        count_order(deltas, row.user_id, update_orders.order_status, row.pizza_size, row.quantity)
+    await apply_counters(session, deltas)
+
+    missing, rejected = [], []
+    if update_orders.order_ids is not None:
+        remaining = set(update_orders.order_ids) - set(updated)
+        existing = set(await session.scalars(select(Order.id).where(Order.id.in_(remaining)))) if remaining else set()
+        missing = sorted(remaining - existing)
+        rejected = sorted(existing)
+
+    await session.commit()
+    await invalidate_orders(updated)
+
+    for row in changed:
+        await broker.publish(user_topic(row.user_id), {"order_id": row.id, "order_status": update_orders.order_status})
+
+    response = {
+        "updated": sorted(updated),
+        "missing": missing,
+        "rejected": rejected
+    }
+    return ORJSONResponse(response)
+
 # Update Order status by id
 @order_router.put("/order/status/{order_id}", status_code=status.HTTP_200_OK)
-async def put_order_status(update_order: OrderStatusModel, order_id:int, Authorize:AuthJWT=Depends()):
+@query_budget(4 + IDEMPOTENCY_QUERIES)
+async def put_order_status(update_order: OrderStatusModel, order_id:int, if_match: Optional[str] = Header(None), idempotent:IdempotentRequest=Depends(idempotency), user:CurrentUser=Depends(get_current_user), session:AsyncSession=Depends(get_db)):
     """
         ## Update Order status by id
         Only staff can update order status
         - On route:
             - order_id: int
+        - On Header:
+            - If-Match: the ETag of the order you changed, 412 if it has changed since
+            - Idempotency-Key: a retry with the same key and body gets the first response back
         - Body: OrderStatusModel
             - order_status: str
     """
-    try:
-        Authorize.jwt_required()
-    except Exception as e:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid Token [UnAuthorized]")
-
-    current_user = Authorize.get_jwt_subject()
-    user = session.query(User).filter(User.username == current_user).first()
     
     if user.is_staff:
-        order = session.query(Order).filter(Order.id == order_id).first()
+        replayed = idempotent.replay()
+        if replayed is not None:
+            return replayed
+
+        check_choices(update_order.order_status)
+
+        order = await session.scalar(select(Order).where(Order.id == order_id))
         if order is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Order not found")
 
+        check_if_match(order, if_match)
+
+        deltas = count_order({}, order.user_id, order.order_status, order.pizza_size, order.quantity, sign=-1)
+
         # update order status
         order.order_status = update_order.order_status
-        session.commit()
+        await apply_counters(session, count_order(deltas, order.user_id, order.order_status, order.pizza_size, order.quantity))
+        await commit_order(session, if_match)
+        await invalidate_orders([order.id])
+
+        await broker.publish(user_topic(order.user_id), {"order_id": order.id, "order_status": order.order_status})
     
         response = {
             "message": "Order status updated successfully",
         }
-        return jsonable_encoder(response)
+        return await idempotent.save(ORJSONResponse(response, headers={"ETag": order_etag(order)}))
     
     raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You don't have permission to update status")
 
 # Delete an order by id
 @order_router.delete("/order/delete/{order_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_order(order_id:int, Authorize:AuthJWT=Depends()):
+@query_budget(4)
+async def delete_order(order_id:int, user:CurrentUser=Depends(get_current_user), session:AsyncSession=Depends(get_db)):
     """
         ## Delete an order by id
         You can only delete the order if its status is pending
@@ -265,32 +524,84 @@ async def delete_order(order_id:int, Authorize:AuthJWT=Depends()):
             - order_id: int
     """
 
-    try:
-        Authorize.jwt_required()
-    except Exception as e:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid Token [UnAuthorized]")
-    
-    current_user = Authorize.get_jwt_subject()
-    user = session.query(User).filter(User.username == current_user).first()
 
-    order = session.query(Order).filter(Order.id == order_id).first()
+    order = await session.scalar(select(Order).where(Order.id == order_id))
 
     if order is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Order not found")
 
     if order.user_id == user.id:
         if order.order_status != "PENDING":
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You can't delete this order becouse is {}".format(order.order_status.code))
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You can't delete this order becouse is {}".format(order.order_status))
 
         # delete order
-        session.delete(order)
-        session.commit()
+        await apply_counters(session, count_order({}, order.user_id, order.order_status, order.pizza_size, order.quantity, sign=-1))
+        await session.delete(order)
+        await commit_order(session)
+        await invalidate_orders([order.id])
 
         response = {
             "message": "Order deleted successfully",
         }
 
-        return jsonable_encoder(response)
+        return response
     
     raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You don't have permission to delete this order")
 
+
+
+async def send_updates(websocket, subscription, order_id, expires):
+    """
+        Forward the messages of a subscription to the socket until the token expires
+    """
+    while True:
+        try:
+            message = await asyncio.wait_for(subscription.get(), timeout=max(0, expires - time.time()))
+        except asyncio.TimeoutError:
+            await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+            return
+
+        if order_id is None or message["order_id"] == order_id:
+            await websocket.send_bytes(orjson.dumps(message))
+
+# Push the status changes of the current user's orders
+@order_router.websocket("/updates")
+async def order_updates(websocket: WebSocket, token: str = Query(...), order_id: Optional[int] = None, Authorize:AuthJWT=Depends()):
+    """
+        ## Order status updates
+        WebSocket sending {"order_id": int, "order_status": str} when one of your orders changes status,
+        instead of polling /user/order/{order_id}
+        - On Query:
+            - token: str, the access token (browsers can't set headers on WebSockets)
+            - order_id: int, only the updates of this order
+        Closed with 1008 if the token is invalid or revoked, and when it expires
+        Refused with 1013 over the rate limit, like a 429 of the other routes
+    """
+    # the router's admission dependency doesn't run on WebSocket routes
+    try:
+        check_rate_limits(websocket, Authorize, token=token)
+    except HTTPException:
+        await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+        return
+
+    try:
+        Authorize.jwt_required("websocket", token=token)
+        claims = Authorize.get_raw_jwt(token)
+
+        # short session, an idle socket doesn't hold a pool connection
+        async with AsyncSessionLocal() as session:
+            user = await user_from_claims(session, claims)
+    except Exception as e:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    await websocket.accept()
+
+    with broker.subscribe(user_topic(user.id)) as subscription:
+        sender = asyncio.create_task(send_updates(websocket, subscription, order_id, claims["exp"]))
+        try:
+            # clients don't send anything, wait for them to go away
+            while (await websocket.receive())["type"] != "websocket.disconnect":
+                pass
+        finally:
+            sender.cancel()
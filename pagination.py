@@ -0,0 +1,52 @@
+import base64
+import binascii
+
+from fastapi import HTTPException, status
+
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(last_id):
+    """
+        Opaque token pointing after the last row of a page
+    """
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """
+        Id to continue after, 0 for the first page
+    """
+    if not cursor:
+        return 0
+
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return int(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+def keyset(statement, column, cursor, limit):
+    """
+        Restrict a select to the page after `cursor`, ordered by `column`
+        One extra row is fetched to know whether there is a next page
+    """
+    return statement.where(column > decode_cursor(cursor)).order_by(column).limit(limit + 1)
+
+
+def page(items, limit, key):
+    """
+        Build the response of a keyset page from up to limit + 1 items
+    """
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(items[-1][key])
+
+    return {
+        "items": items,
+        "next_cursor": next_cursor,
+    }
@@ -0,0 +1,122 @@
+import asyncio
+
+import environ
+
+from cache import load_backend
+
+
+env = environ.Env(DEBUG=(bool, False))
+environ.Env.read_env(".env")
+
+# Dotted path of the Broker class, swap it for a shared backend when running several workers
+PUBSUB_BACKEND = env("PUBSUB_BACKEND", default="pubsub.InProcessBroker")
+
+# Messages kept per subscriber, the oldest ones are dropped when a client doesn't keep up
+PUBSUB_QUEUE_SIZE = env.int("PUBSUB_QUEUE_SIZE", default=16)
+
+
+def user_topic(user_id):
+    return "user:{}".format(user_id)
+
+
+class Subscription:
+    """
+        One subscriber of a topic, a bounded queue that never blocks the publisher
+    """
+
+    __slots__ = ("broker", "topic", "queue", "dropped")
+
+    def __init__(self, broker, topic, maxsize):
+        self.broker = broker
+        self.topic = topic
+        self.queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+
+    def put(self, message):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(message)
+
+    async def get(self):
+        return await self.queue.get()
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Broker:
+    """
+        Publish/subscribe interface used by the routes
+        - publish(topic, message): send a message to every subscriber of the topic, in any worker
+        - subscribe(topic): a Subscription local to this worker, close() it when done
+        - start()/stop(): open and close the backend connections, on app startup/shutdown
+    """
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, topic, message):
+        raise NotImplementedError
+
+    def subscribe(self, topic):
+        raise NotImplementedError
+
+    def unsubscribe(self, subscription):
+        raise NotImplementedError
+
+    def stats(self):
+        return {}
+
+
+class InProcessBroker(Broker):
+    """
+        Fan-out to the subscribers of this worker only
+        A shared backend (Redis, Postgres LISTEN/NOTIFY...) subclasses it: publish() sends to the
+        backend, and a listener started in start() hands every message it receives to deliver()
+    """
+
+    def __init__(self, queue_size=None):
+        self.queue_size = PUBSUB_QUEUE_SIZE if queue_size is None else queue_size
+        self.topics = {}
+        self.published = 0
+
+    async def publish(self, topic, message):
+        self.deliver(topic, message)
+
+    def deliver(self, topic, message):
+        self.published += 1
+        for subscription in tuple(self.topics.get(topic, ())):
+            subscription.put(message)
+
+    def subscribe(self, topic):
+        subscription = Subscription(self, topic, self.queue_size)
+        self.topics.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscribers = self.topics.get(subscription.topic)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self.topics[subscription.topic]
+
+    def stats(self):
+        return {
+            "backend": type(self).__name__,
+            "topics": len(self.topics),
+            "subscribers": sum(len(subscribers) for subscribers in self.topics.values()),
+            "published": self.published,
+        }
+
+
+broker = load_backend(PUBSUB_BACKEND)
@@ -0,0 +1,90 @@
+import warnings
+from collections import Counter
+
+import environ
+
+from database import current_statements
+
+
+env = environ.Env(DEBUG=(bool, False))
+environ.Env.read_env(".env")
+
+# "off", "warn" (QueryBudgetWarning) or "raise" (QueryBudgetExceeded, fails the test client call)
+QUERY_BUDGET_MODE = env("QUERY_BUDGET_MODE", default="off")
+
+# Times one statement may run in a request before it's reported as a likely N+1
+QUERY_REPEAT_LIMIT = env.int("QUERY_REPEAT_LIMIT", default=3)
+
+
+class QueryBudgetWarning(UserWarning):
+    pass
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def query_budget(queries=None, repeats=None):
+    """
+        Declare the most SQL statements a route may run per request, auth lookups included
+        repeats overrides QUERY_REPEAT_LIMIT for routes that legitimately repeat a statement
+        Put it under the route decorator:
+
+            @order_router.get("/{order_id}")
+            @query_budget(2)
+            async def get_order(...):
+    """
+    def decorator(endpoint):
+        endpoint.query_budget = (queries, repeats)
+        return endpoint
+
+    return decorator
+
+
+def budget_problems(endpoint, statements):
+    """
+        What's wrong with the statements a request ran, against the budget of its endpoint
+    """
+    queries, repeats = getattr(endpoint, "query_budget", (None, None))
+    repeats = QUERY_REPEAT_LIMIT if repeats is None else repeats
+    problems = []
+
+    if queries is not None and len(statements) > queries:
+        problems.append("ran {} queries, the budget is {}".format(len(statements), queries))
+
+    for statement, count in Counter(statements).most_common():
+        if count <= repeats:
+            break
+        problems.append("ran {} times: {}".format(count, " ".join(statement.split())[:200]))
+
+    return problems
+
+
+class QueryBudgetMiddleware:
+    """
+        Pure ASGI middleware collecting the SQL statements of every HTTP request
+        Meant for development and tests, only installed when QUERY_BUDGET_MODE isn't "off"
+    """
+
+    def __init__(self, app, mode=None):
+        self.app = app
+        self.mode = mode or QUERY_BUDGET_MODE
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        statements = []
+        token = current_statements.set(statements)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_statements.reset(token)
+
+        problems = budget_problems(scope.get("endpoint"), statements)
+        if problems:
+            message = "{} {}: {}".format(scope["method"], scope["path"], "; ".join(problems))
+            if self.mode == "raise":
+                raise QueryBudgetExceeded(message)
+            warnings.warn(message, QueryBudgetWarning)
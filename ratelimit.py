@@ -0,0 +1,191 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict
+
+from fastapi import Depends, HTTPException, status
+from fastapi_jwt_auth import AuthJWT
+from starlette.requests import Request
+import environ
+
+from database import MAX_OVERFLOW, POOL_SIZE
+
+
+env = environ.Env(DEBUG=(bool, False))
+environ.Env.read_env(".env")
+
+# Requests per second and burst of each authenticated user (JWT subject), 0 disables
+RATE_LIMIT_USER_RATE = env.float("RATE_LIMIT_USER_RATE", default=10)
+RATE_LIMIT_USER_BURST = env.int("RATE_LIMIT_USER_BURST", default=20)
+
+# Requests per second and burst of each client IP, authenticated or not, 0 disables
+RATE_LIMIT_IP_RATE = env.float("RATE_LIMIT_IP_RATE", default=50)
+RATE_LIMIT_IP_BURST = env.int("RATE_LIMIT_IP_BURST", default=100)
+
+# Buckets kept per worker, the least recently used are dropped (and start full again)
+RATE_LIMIT_BUCKETS = env.int("RATE_LIMIT_BUCKETS", default=100000)
+
+# Requests served at once per worker, by default as many as the pool has connections, 0 disables
+ADMISSION_LIMIT = env.int("ADMISSION_LIMIT", default=POOL_SIZE + MAX_OVERFLOW)
+
+# Requests waiting for a slot before the next ones get a 503, and how long they wait
+ADMISSION_QUEUE = env.int("ADMISSION_QUEUE", default=2 * ADMISSION_LIMIT)
+ADMISSION_TIMEOUT = env.float("ADMISSION_TIMEOUT", default=1)
+
+
+class TokenBuckets:
+    """
+        Token buckets by key, in a bounded LRU
+        A bucket holds up to `burst` tokens and gets `rate` back per second, a request takes one
+    """
+
+    def __init__(self, rate, burst, maxsize):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self.limited = 0
+        self._buckets = OrderedDict()
+
+    def take(self, key, now=None):
+        """
+            Take a token, return 0 or the seconds until the next one if the bucket is empty
+        """
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [float(self.burst), now]
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] < 1:
+            self.limited += 1
+            return (1 - bucket[0]) / self.rate
+
+        bucket[0] -= 1
+        return 0
+
+    def stats(self):
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "size": len(self._buckets),
+            "maxsize": self.maxsize,
+            "limited": self.limited,
+        }
+
+
+user_buckets = TokenBuckets(RATE_LIMIT_USER_RATE, RATE_LIMIT_USER_BURST, RATE_LIMIT_BUCKETS)
+ip_buckets = TokenBuckets(RATE_LIMIT_IP_RATE, RATE_LIMIT_IP_BURST, RATE_LIMIT_BUCKETS)
+
+# created on first use, in the event loop of the worker
+_slots = None
+_active = 0
+_waiting = 0
+_shed = 0
+
+
+def retry_after(seconds):
+    return {"Retry-After": str(max(1, math.ceil(seconds)))}
+
+
+def server_busy():
+    global _shed
+
+    _shed += 1
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Server is busy, retry later",
+        headers=retry_after(ADMISSION_TIMEOUT)
+    )
+
+
+def check_rate_limits(connection, Authorize, token=None):
+    """
+        429 when the client IP or the user of the access token has used up its bucket
+        token: the access token when it isn't sent in the headers, e.g. in a WebSocket's query
+    """
+    checks = []
+    if RATE_LIMIT_IP_RATE > 0 and connection.client is not None:
+        checks.append((ip_buckets, connection.client.host))
+
+    if RATE_LIMIT_USER_RATE > 0:
+        # only a verified token counts, so nobody can drain another user's bucket
+        try:
+            if token is None:
+                Authorize.jwt_optional()
+                subject = Authorize.get_jwt_subject()
+            else:
+                Authorize.jwt_optional("websocket", token=token)
+                subject = Authorize.get_raw_jwt(token)["sub"]
+        except Exception:
+            subject = None
+        if subject is not None:
+            checks.append((user_buckets, subject))
+
+    for buckets, key in checks:
+        wait = buckets.take(key)
+        if wait:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests, retry later",
+                headers=retry_after(wait)
+            )
+
+
+async def admission(request: Request, Authorize:AuthJWT=Depends()):
+    """
+        Router dependency shedding load before it reaches the database
+        - 429 once the client IP or the user is over its rate limit
+        - 503 when ADMISSION_LIMIT requests are being served and ADMISSION_QUEUE more are waiting,
+          or after waiting ADMISSION_TIMEOUT seconds for a slot
+        The slot is held until the response is sent
+        FastAPI doesn't run router dependencies on WebSocket routes: they call check_rate_limits
+        themselves before accepting, and hold no slot
+    """
+    global _slots, _active, _waiting
+
+    check_rate_limits(request, Authorize)
+
+    if ADMISSION_LIMIT <= 0:
+        yield
+        return
+
+    if _slots is None:
+        _slots = asyncio.Semaphore(ADMISSION_LIMIT)
+
+    if _slots.locked():
+        if _waiting >= ADMISSION_QUEUE:
+            raise server_busy()
+
+        _waiting += 1
+        try:
+            await asyncio.wait_for(_slots.acquire(), ADMISSION_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise server_busy()
+        finally:
+            _waiting -= 1
+    else:
+        await _slots.acquire()
+
+    _active += 1
+    try:
+        yield
+    finally:
+        _active -= 1
+        _slots.release()
+
+
+def admission_stats():
+    return {
+        "limit": ADMISSION_LIMIT,
+        "queue_limit": ADMISSION_QUEUE,
+        "active": _active,
+        "waiting": _waiting,
+        "shed": _shed,
+        "user_buckets": user_buckets.stats(),
+        "ip_buckets": ip_buckets.stats(),
+    }
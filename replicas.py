@@ -0,0 +1,189 @@
+import asyncio
+import itertools
+import warnings
+
+import environ
+from fastapi import Depends
+from sqlalchemy import event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from cache import TTLCache
+from database import AsyncSessionLocal, PrimarySession, async_url, current_user_id, engine_options, get_db, instrument
+from security import CurrentUser, get_current_user
+
+
+env = environ.Env(DEBUG=(bool, False))
+environ.Env.read_env(".env")
+
+# Read replicas of DATABASE_URL, comma separated, the read routes are spread over them
+# (e.g. sqlite:///./replica.db for local runs, a copy of the primary file)
+REPLICA_DATABASE_URLS = env.list("REPLICA_DATABASE_URLS", default=[])
+
+# Replicas lagging more than this many seconds behind the primary are left out until they catch up
+REPLICA_MAX_LAG = env.float("REPLICA_MAX_LAG", default=5)
+
+# Seconds between two health checks of the replicas, and how long a check may take
+REPLICA_HEALTH_INTERVAL = env.float("REPLICA_HEALTH_INTERVAL", default=5)
+REPLICA_HEALTH_TIMEOUT = env.float("REPLICA_HEALTH_TIMEOUT", default=2)
+
+# How long the reads of a user go to the primary after one of their writes, so they see it
+READ_YOUR_WRITES_WINDOW = env.float("READ_YOUR_WRITES_WINDOW", default=REPLICA_MAX_LAG)
+READ_YOUR_WRITES_CACHE_SIZE = env.int("READ_YOUR_WRITES_CACHE_SIZE", default=100000)
+
+# Seconds a replica lags behind the primary, for the backends that can tell
+LAG_QUERIES = {
+    "postgresql": (
+        "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+        "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+    ),
+}
+
+
+class Replica:
+    """
+        A read replica, its engine and the outcome of its last health check
+    """
+
+    def __init__(self, url):
+        self.name = make_url(url).render_as_string(hide_password=True)
+        self.engine = create_async_engine(async_url(url), future=True, **engine_options(url))
+        self.sessionmaker = sessionmaker(bind=self.engine, class_=AsyncSession, expire_on_commit=False, info={"replica": True})
+        self.healthy = True
+        self.lag = None
+        self.error = None
+        instrument(self.engine)
+
+    async def measure_lag(self):
+        async with self.engine.connect() as connection:
+            return float(await connection.scalar(text(LAG_QUERIES.get(self.engine.dialect.name, "SELECT 0"))))
+
+    async def check(self):
+        try:
+            self.lag = await asyncio.wait_for(self.measure_lag(), REPLICA_HEALTH_TIMEOUT)
+        except Exception as e:
+            self.healthy, self.lag, self.error = False, None, repr(e)
+            return False
+
+        self.healthy, self.error = self.lag <= REPLICA_MAX_LAG, None
+        return self.healthy
+
+    def stats(self):
+        return {"name": self.name, "healthy": self.healthy, "lag": self.lag, "error": self.error}
+
+
+replicas = [Replica(url) for url in REPLICA_DATABASE_URLS]
+
+# user ids with a write committed in the last READ_YOUR_WRITES_WINDOW seconds, per worker
+recent_writers = TTLCache(maxsize=READ_YOUR_WRITES_CACHE_SIZE, ttl=READ_YOUR_WRITES_WINDOW)
+
+_round_robin = itertools.count()
+
+
+def pick_replica():
+    """
+        Next healthy replica, round robin, None when none is healthy
+    """
+    healthy = [replica for replica in replicas if replica.healthy]
+    if not healthy:
+        return None
+    return healthy[next(_round_robin) % len(healthy)]
+
+
+def read_sessionmaker(user_id=None):
+    """
+        Sessionmaker of the next read of a user: a healthy replica, or the primary
+        if there is none or the user wrote in the last READ_YOUR_WRITES_WINDOW seconds
+    """
+    if not replicas or wrote_recently(user_id):
+        return AsyncSessionLocal
+
+    replica = pick_replica()
+    return AsyncSessionLocal if replica is None else replica.sessionmaker
+
+
+def wrote_recently(user_id):
+    """
+        Whether a user wrote in the last READ_YOUR_WRITES_WINDOW seconds, their reads must see it
+        Always False without replicas, every read sees the primary then
+    """
+    return bool(replicas) and user_id is not None and user_id in recent_writers
+
+
+def mark_write(user_id):
+    """
+        Send the reads of a user to the primary for the next READ_YOUR_WRITES_WINDOW seconds
+        Commits of the request sessions call it, writes committed elsewhere have to
+    """
+    if user_id is not None:
+        recent_writers.set(user_id, True)
+
+
+async def get_read_db(user:CurrentUser=Depends(get_current_user), session:AsyncSession=Depends(get_db)):
+    """
+        Request-scoped session dependency of the read-only routes, on a replica when there is one
+        Reads on the primary use the request's session, the one get_current_user used, so a
+        request never holds two primary connections
+    """
+    session_factory = read_sessionmaker(user.id)
+    if session_factory is AsyncSessionLocal:
+        yield session
+        return
+
+    # the auth lookup may have left the primary session with a connection, give it back
+    await session.close()
+    async with session_factory() as replica_session:
+        yield replica_session
+
+
+async def check_replicas():
+    return await asyncio.gather(*(replica.check() for replica in replicas))
+
+
+async def monitor_replicas(interval=None):
+    """
+        Check the replicas every REPLICA_HEALTH_INTERVAL seconds, started with the app
+    """
+    interval = REPLICA_HEALTH_INTERVAL if interval is None else interval
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await check_replicas()
+        except Exception as e:
+            warnings.warn("Replica health check failed: {!r}".format(e))
+
+
+async def dispose_replicas():
+    for replica in replicas:
+        await replica.engine.dispose()
+
+
+def replica_status():
+    return {
+        "replicas": [replica.stats() for replica in replicas],
+        "recent_writers": len(recent_writers),
+    }
+
+
+# Writes of the request sessions on the primary, the user of the request sticks to the primary once they commit
+@event.listens_for(PrimarySession, "do_orm_execute")
+def _on_execute(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info["wrote"] = True
+
+
+@event.listens_for(PrimarySession, "after_flush")
+def _on_flush(session, flush_context):
+    session.info["wrote"] = True
+
+
+@event.listens_for(PrimarySession, "after_commit")
+def _on_commit(session):
+    if session.info.pop("wrote", False):
+        mark_write(current_user_id.get())
+
+
+@event.listens_for(PrimarySession, "after_rollback")
+def _on_rollback(session):
+    session.info.pop("wrote", None)
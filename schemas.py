@@ -1,6 +1,6 @@
 
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 import environ
 
 
@@ -90,7 +90,7 @@ class UpdateOrderModel(BaseModel):
 
 
 class OrderStatusModel(BaseModel):
-    order_status:Optional[str]
+    order_status:str
 
     class Config:
         orm_mode=True
@@ -98,4 +98,19 @@ class OrderStatusModel(BaseModel):
             "example":{
                 "order_status":"PENDING"
             }
-        }
\ No newline at end of file
+        }
+
+
+class BulkOrderStatusModel(BaseModel):
+    order_status:str
+    order_ids:Optional[List[int]]
+    pizza_size:Optional[str]
+    user_id:Optional[int]
+
+    class Config:
+        schema_extra={
+            "example":{
+                "order_status":"IN-TRANSIT",
+                "order_ids":[1,2,3]
+            }
+        }
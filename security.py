@@ -0,0 +1,147 @@
+from typing import NamedTuple
+
+from fastapi import Depends, HTTPException, Security, status
+from fastapi.security import HTTPBearer
+from fastapi_jwt_auth import AuthJWT
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+import environ
+
+from cache import TTLCache
+from database import current_user_id, get_db
+from models import User
+
+
+env = environ.Env(DEBUG=(bool, False))
+environ.Env.read_env(".env")
+
+# "claims": trust the token claims, "db": resolve the user from the database by subject
+AUTH_IDENTITY = env("AUTH_IDENTITY", default="claims")
+
+# How long a user's active/staff flags are trusted before being re-read from the database
+AUTH_STATUS_TTL = env.float("AUTH_STATUS_TTL", default=30)
+AUTH_STATUS_CACHE_SIZE = env.int("AUTH_STATUS_CACHE_SIZE", default=10000)
+
+# How long a resolved user is reused in "db" mode
+AUTH_USER_CACHE_TTL = env.float("AUTH_USER_CACHE_TTL", default=60)
+AUTH_USER_CACHE_SIZE = env.int("AUTH_USER_CACHE_SIZE", default=10000)
+
+
+# Declares the "Bearer Auth" requirement in the OpenAPI schema of the routes using it,
+# the token itself is read by AuthJWT
+bearer_scheme = HTTPBearer(scheme_name="Bearer Auth", auto_error=False)
+
+
+class CurrentUser(NamedTuple):
+    id: int
+    username: str
+    is_staff: bool
+
+
+class UserStatus(NamedTuple):
+    is_active: bool
+    is_staff: bool
+
+
+user_status_cache = TTLCache(maxsize=AUTH_STATUS_CACHE_SIZE, ttl=AUTH_STATUS_TTL)
+
+# keyed by JWT subject (username)
+user_cache = TTLCache(maxsize=AUTH_USER_CACHE_SIZE, ttl=AUTH_USER_CACHE_TTL)
+
+
+def user_claims(user):
+    """
+        Claims embedded in access tokens so handlers don't have to look the user up
+    """
+    return {
+        "uid": user.id,
+        "staff": bool(user.is_staff),
+        "active": bool(user.is_active),
+    }
+
+
+def invalidate_user(user_id=None, username=None):
+    """
+        Drop the cached entries of a user after creating or changing it
+    """
+    if user_id is not None:
+        user_status_cache.pop(user_id)
+    if username is not None:
+        user_cache.pop(username)
+
+
+def cache_stats():
+    return {
+        "user_status": user_status_cache.stats(),
+        "user": user_cache.stats(),
+    }
+
+
+async def get_user_status(session, user_id):
+    user_status = user_status_cache.get(user_id)
+    if user_status is None:
+        row = (await session.execute(
+            select(User.is_active, User.is_staff).where(User.id == user_id)
+        )).first()
+        if row is None:
+            return None
+
+        user_status = UserStatus(bool(row.is_active), bool(row.is_staff))
+        user_status_cache.set(user_id, user_status)
+
+    return user_status
+
+
+async def resolve_user(session, username):
+    """
+        Look the user up by JWT subject, through user_cache
+    """
+    current_user = user_cache.get(username)
+    if current_user is None:
+        row = (await session.execute(
+            select(User.id, User.username, User.is_staff).where(User.username == username)
+        )).first()
+        if row is None:
+            return None
+
+        current_user = CurrentUser(row.id, row.username, bool(row.is_staff))
+        user_cache.set(username, current_user)
+
+    return current_user
+
+
+async def get_current_user(Authorize:AuthJWT=Depends(), session:AsyncSession=Depends(get_db), credentials=Security(bearer_scheme)):
+    """
+        Resolve the user of the access token
+        - "claims" mode: from its claims, checked against the user's current flags (cached for
+          AUTH_STATUS_TTL seconds), so deactivating or demoting a user revokes the tokens already issued
+        - "db" mode: from the database by subject, cached for AUTH_USER_CACHE_TTL seconds
+    """
+    try:
+        Authorize.jwt_required()
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid Token [UnAuthorized]")
+
+    current_user = await user_from_claims(session, Authorize.get_raw_jwt())
+    current_user_id.set(current_user.id)
+    return current_user
+
+
+async def user_from_claims(session, claims):
+    """
+        The CurrentUser of verified access token claims, raise a 401 if it was revoked
+    """
+    username = claims["sub"]
+
+    # tokens issued before the claims were added go through the database too
+    if AUTH_IDENTITY == "db" or "uid" not in claims:
+        current_user = await resolve_user(session, username)
+        if current_user is None:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid Token [UnAuthorized]")
+        return current_user
+
+    user_status = await get_user_status(session, claims["uid"])
+    if user_status is None or (claims.get("active") and not user_status.is_active):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token has been revoked")
+
+    return CurrentUser(claims["uid"], username, bool(claims.get("staff")) and user_status.is_staff)
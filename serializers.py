@@ -0,0 +1,58 @@
+from models import Order, User
+
+
+# Columns selected by the read routes, rows are serialized without hydrating ORM objects
+ORDER_COLUMNS = (Order.id, Order.quantity, Order.order_status, Order.pizza_size, Order.user_id)
+USER_COLUMNS = (User.id, User.username, User.email, User.is_staff, User.is_active)
+
+
+def serialize_order(order):
+    """
+        Response shape of an order, from an Order or a row of ORDER_COLUMNS
+    """
+    return {
+        "order_id": order.id,
+        "quantity": order.quantity,
+        "order_status": order.order_status,
+        "pizza_size": order.pizza_size,
+        "user_id": order.user_id
+    }
+
+
+def serialize_user(user):
+    """
+        Response shape of a user, from a User or a row of USER_COLUMNS
+    """
+    return {
+        "id": user.id,
+        "username": user.username,
+        "email": user.email,
+        "is_staff": user.is_staff,
+        "is_active": user.is_active
+    }
+
+
+def order_etag(order):
+    """
+        ETag of an order, from its id and row version
+    """
+    return '"{}-{}"'.format(order.id, order.version)
+
+
+def etag_matches(header, etag, weak=True):
+    """
+        Whether an If-None-Match (weak comparison) or If-Match (strong) header matches an ETag
+    """
+    if header is None:
+        return False
+
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if weak and tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+
+    return False
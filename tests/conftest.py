@@ -0,0 +1,79 @@
+"""
+    Shared setup of the tests: a fresh SQLite database migrated to head, the app run with
+    QUERY_BUDGET_MODE=raise and the order cache on cache.FakeCache, and authenticated users
+"""
+import os
+import sys
+import tempfile
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, ROOT)
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test.db")
+os.environ.setdefault("SECRET_KEY", "test")
+# a request over its query budget fails the test client call
+os.environ["QUERY_BUDGET_MODE"] = "raise"
+os.environ["ORDER_CACHE_BACKEND"] = "cache.FakeCache"
+# every test client shares one IP
+os.environ["RATE_LIMIT_USER_RATE"] = "0"
+os.environ["RATE_LIMIT_IP_RATE"] = "0"
+os.environ["ADMISSION_LIMIT"] = "0"
+# no background tasks
+os.environ["ORDER_COUNTER_RECONCILE_INTERVAL"] = "0"
+os.environ["IDEMPOTENCY_PURGE_INTERVAL"] = "0"
+os.environ["REPLICA_HEALTH_INTERVAL"] = "0"
+
+import pytest
+from starlette.testclient import TestClient
+
+
+@pytest.fixture(scope="session")
+def app():
+    import init_db  # migrates the database to head
+    from main import app
+
+    return app
+
+
+@pytest.fixture(scope="session")
+def client(app):
+    with TestClient(app) as client:
+        yield client
+
+
+def signup_and_login(client, is_staff=False):
+    """
+        Create a throwaway user, return their authorization headers
+    """
+    username = "test-{}".format(uuid.uuid4().hex[:12])
+    response = client.post("/api/auth/signup", json={
+        "username": username,
+        "email": "{}@example.com".format(username),
+        "password": "password",
+        "is_staff": is_staff,
+        "is_active": True,
+    })
+    assert response.status_code == 201, response.text
+    response = client.post("/api/auth/login", json={"username": username, "password": "password"})
+    return {"Authorization": "Bearer " + response.json()["access_token"]}
+
+
+@pytest.fixture
+def user(client):
+    return signup_and_login(client)
+
+
+@pytest.fixture
+def staff(client):
+    return signup_and_login(client, is_staff=True)
+
+
+@pytest.fixture
+def create_order(client, user):
+    def create_order(**order):
+        response = client.post("/api/orders/order", json={"quantity": 1, "pizza_size": "LARGE", **order}, headers=user)
+        assert response.status_code == 201, response.text
+        return response.json()
+
+    return create_order
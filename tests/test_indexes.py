@@ -0,0 +1,24 @@
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from check_indexes import HOT_QUERIES, explain
+from crud import transition_filter
+from database import engine
+from order_routes import order_filters
+
+
+@pytest.mark.parametrize("name, statement, expected", HOT_QUERIES, ids=[name for name, statement, expected in HOT_QUERIES])
+def test_hot_query_uses_its_index(app, name, statement, expected):
+    with engine.connect() as connection:
+        assert explain(connection, statement) & expected
+
+
+@pytest.mark.parametrize("condition, sql", [
+    (order_filters(order_status="PENDING")[0], "orders.order_status = 1"),
+    (transition_filter("IN-TRANSIT"), "orders.order_status IN (1)"),
+])
+def test_status_is_inlined(condition, sql):
+    # a bound status is planned for any value on Postgres, then ix_orders_active_status can't serve it
+    compiled = condition.compile(dialect=postgresql.asyncpg.dialect())
+    assert str(compiled) == sql
+    assert not compiled.params
@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+
+from database import AsyncSessionLocal
+from order_cache import get_cached_order, invalidate_orders, loading, order_cache, order_key
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    order_cache.data.clear()
+    order_cache.calls.clear()
+
+
+def test_read_through(client, user, create_order):
+    order = create_order()
+    key = order_key(order["order_id"])
+
+    first = client.get("/api/orders/{}".format(order["order_id"]), headers=user)
+    second = client.get("/api/orders/user/order/{}".format(order["order_id"]), headers=user)
+
+    assert first.json() == second.json() == order
+    assert first.headers["ETag"] == second.headers["ETag"]
+    assert order_cache.calls == [("get", key), ("set", key), ("get", key)]
+
+
+def test_patch_invalidates(client, user, create_order):
+    order = create_order()
+    key = order_key(order["order_id"])
+    etag = client.get("/api/orders/{}".format(order["order_id"]), headers=user).headers["ETag"]
+
+    response = client.patch("/api/orders/order/update/{}".format(order["order_id"]), json={"quantity": 3}, headers={**user, "If-Match": etag})
+    assert response.status_code == 202, response.text
+    assert ("delete", key) in order_cache.calls
+    assert key not in order_cache.data
+
+    response = client.get("/api/orders/{}".format(order["order_id"]), headers=user)
+    assert response.json()["quantity"] == 3
+    assert response.headers["ETag"] != etag
+
+
+def test_status_invalidates(client, user, staff, create_order):
+    order = create_order()
+    key = order_key(order["order_id"])
+    client.get("/api/orders/{}".format(order["order_id"]), headers=user)
+
+    response = client.put("/api/orders/order/status/{}".format(order["order_id"]), json={"order_status": "IN-TRANSIT"}, headers=staff)
+    assert response.status_code == 200, response.text
+    assert key not in order_cache.data
+
+    assert client.get("/api/orders/{}".format(order["order_id"]), headers=user).json()["order_status"] == "IN-TRANSIT"
+
+
+def test_bulk_status_invalidates(client, user, staff, create_order):
+    orders = [create_order(), create_order()]
+    for order in orders:
+        client.get("/api/orders/{}".format(order["order_id"]), headers=user)
+
+    response = client.put("/api/orders/order/status/bulk", json={
+        "order_status": "IN-TRANSIT",
+        "order_ids": [order["order_id"] for order in orders],
+    }, headers=staff)
+    assert response.json()["updated"] == sorted(order["order_id"] for order in orders)
+    assert not any(order_key(order["order_id"]) in order_cache.data for order in orders)
+
+    for order in orders:
+        assert client.get("/api/orders/{}".format(order["order_id"]), headers=user).json()["order_status"] == "IN-TRANSIT"
+
+
+def test_delete_invalidates(client, user, create_order):
+    order = create_order()
+    client.get("/api/orders/{}".format(order["order_id"]), headers=user)
+
+    response = client.delete("/api/orders/order/delete/{}".format(order["order_id"]), headers=user)
+    assert response.status_code == 204, response.text
+    assert order_key(order["order_id"]) not in order_cache.data
+
+    assert client.get("/api/orders/{}".format(order["order_id"]), headers=user).status_code == 404
+
+
+class SlowSession:
+    """
+        Session whose reads take a while, for a change to be committed while one is in flight
+    """
+
+    def __init__(self, session, delay):
+        self.session = session
+        self.delay = delay
+        self.info = session.info
+
+    async def execute(self, statement):
+        result = await self.session.execute(statement)
+        await asyncio.sleep(self.delay)
+        return result
+
+
+def test_read_racing_a_change_is_not_cached(client, create_order):
+    order = create_order()
+    key = order_key(order["order_id"])
+
+    async def race():
+        async with AsyncSessionLocal() as session:
+            read = asyncio.create_task(get_cached_order(SlowSession(session, 0.05), order["order_id"]))
+            await asyncio.sleep(0.01)
+            # the read has loaded the order, the change is committed before it caches it
+            await invalidate_orders([order["order_id"]])
+            return await read
+
+    entry = client.portal.call(race)
+
+    assert entry["order"] == order
+    assert key not in order_cache.data
+    assert key not in loading
+
+    async def read():
+        async with AsyncSessionLocal() as session:
+            return await get_cached_order(session, order["order_id"])
+
+    client.portal.call(read)
+    assert key in order_cache.data
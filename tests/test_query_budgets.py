@@ -0,0 +1,93 @@
+"""
+    Every route run within its @query_budget: conftest sets QUERY_BUDGET_MODE=raise, so a request
+    over its budget fails the test client call. The auth caches are emptied before each test, so
+    the first requests of its users look them up, and the orders read were never cached
+"""
+import uuid
+
+import pytest
+
+import order_routes
+from conftest import signup_and_login
+from query_budget import QueryBudgetExceeded
+from security import user_cache, user_status_cache
+
+
+@pytest.fixture(autouse=True)
+def empty_auth_caches(user, staff):
+    user_cache.clear()
+    user_status_cache.clear()
+
+
+def idempotency_key():
+    return {"Idempotency-Key": uuid.uuid4().hex}
+
+
+def test_budget_is_enforced(client, user, create_order, monkeypatch):
+    order = create_order()
+    monkeypatch.setattr(order_routes.get_order, "query_budget", (0, None))
+
+    with pytest.raises(QueryBudgetExceeded):
+        client.get("/api/orders/{}".format(order["order_id"]), headers=user)
+
+
+def test_auth_routes(client, staff):
+    username = "test-{}".format(uuid.uuid4().hex[:12])
+    response = client.post("/api/auth/signup", json={"username": username, "email": "{}@example.com".format(username), "password": "password"})
+    assert response.status_code == 201, response.text
+
+    response = client.post("/api/auth/login", json={"username": username, "password": "password"})
+    assert response.status_code == 200, response.text
+
+    refresh = {"Authorization": "Bearer " + response.json()["refresh_token"]}
+    assert client.post("/api/auth/refresh", headers=refresh).status_code == 200
+    assert client.get("/api/auth/all", headers=staff).status_code == 200
+
+
+def test_order_reads(client, user, create_order):
+    order = create_order()
+    staff = signup_and_login(client, is_staff=True)
+
+    assert client.get("/api/orders/{}".format(order["order_id"]), headers=user).status_code == 200
+    assert client.get("/api/orders/user/order/{}".format(order["order_id"]), headers=user).status_code == 200
+    assert client.get("/api/orders/user/orders", headers=user).status_code == 200
+    assert client.get("/api/orders/all?order_status=PENDING", headers=staff).status_code == 200
+    assert client.get("/api/orders/stats", headers=staff).status_code == 200
+
+    response = client.get("/api/orders/export?format=csv", headers=staff)
+    assert response.status_code == 200
+    assert response.text.startswith("order_id,")
+
+
+@pytest.mark.parametrize("headers", [{}, idempotency_key()])
+def test_order_writes(client, user, staff, headers):
+    response = client.post("/api/orders/order", json={"quantity": 1, "pizza_size": "LARGE"}, headers={**user, **headers})
+    assert response.status_code == 201, response.text
+    order_id = response.json()["order_id"]
+
+    response = client.patch("/api/orders/order/update/{}".format(order_id), json={"quantity": 2}, headers={**user, **idempotency_key()})
+    assert response.status_code == 202, response.text
+
+    response = client.put("/api/orders/order/status/{}".format(order_id), json={"order_status": "IN-TRANSIT"}, headers={**staff, **idempotency_key()})
+    assert response.status_code == 200, response.text
+
+    order_id = client.post("/api/orders/order", json={"quantity": 1}, headers=user).json()["order_id"]
+    assert client.delete("/api/orders/order/delete/{}".format(order_id), headers=user).status_code == 204
+
+
+def test_idempotent_replay(client, user):
+    headers = {**user, **idempotency_key()}
+    first = client.post("/api/orders/order", json={"quantity": 1}, headers=headers)
+    replayed = client.post("/api/orders/order", json={"quantity": 1}, headers=headers)
+
+    assert replayed.headers["Idempotent-Replayed"] == "true"
+    assert replayed.json() == first.json()
+
+
+def test_bulk_routes(client, user, staff):
+    response = client.post("/api/orders/order/bulk", json=[{"quantity": 1, "pizza_size": "SMALL"}] * 20, headers=user)
+    assert response.status_code == 201, response.text
+
+    response = client.put("/api/orders/order/status/bulk", json={"order_status": "IN-TRANSIT", "pizza_size": "SMALL"}, headers=staff)
+    assert response.status_code == 200, response.text
+    assert response.json()["updated"]
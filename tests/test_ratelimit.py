@@ -0,0 +1,29 @@
+import pytest
+from starlette import status
+from starlette.websockets import WebSocketDisconnect
+
+import ratelimit
+from ratelimit import TokenBuckets
+
+
+def access_token(headers):
+    return headers["Authorization"].split()[1]
+
+
+@pytest.mark.parametrize("setting, buckets", [
+    ("RATE_LIMIT_IP_RATE", "ip_buckets"),
+    ("RATE_LIMIT_USER_RATE", "user_buckets"),
+])
+def test_order_updates_is_rate_limited(client, user, monkeypatch, setting, buckets):
+    monkeypatch.setattr(ratelimit, setting, 1)
+    monkeypatch.setattr(ratelimit, buckets, TokenBuckets(rate=0.001, burst=1, maxsize=10))
+    url = "/api/orders/updates?token={}".format(access_token(user))
+
+    with client.websocket_connect(url):
+        pass
+
+    with pytest.raises(WebSocketDisconnect) as refused:
+        with client.websocket_connect(url):
+            pass
+    assert refused.value.code == status.WS_1013_TRY_AGAIN_LATER
+    assert getattr(ratelimit, buckets).limited == 1